@@ -0,0 +1,110 @@
+from concurrent.futures import Future
+import numpy as np
+import asyncio
+import queue
+import threading
+import time
+
+
+class BatchEvaluator:
+    """Serves concurrent queries on one shared compiled SPN by micro-batching them
+
+    Requests from any number of threads (or asyncio tasks) are queued, and worker threads
+    combine whatever is waiting, up to max_batch_size rows or max_delay seconds, into one
+    vectorised evaluate_batch call. Every call owns its evidence and scratch buffers, so the
+    compiled SPN is only read and can be shared, e.g. memory-mapped with CompiledSPN.load.
+    It must not be trained while it is being served.
+    """
+    def __init__(self, compiled, variables=None, max_batch_size=1024, max_delay=0.001,
+                 log_mode=False, num_workers=1):
+        self.compiled = compiled
+        self.variables = variables  # When given, requests hold binary samples instead of leaf values
+        self.max_batch_size = max_batch_size
+        self.max_delay = max_delay
+        self.log_mode = log_mode
+        self.queue = queue.Queue()
+        self.workers = [threading.Thread(target=self.run, daemon=True) for _ in range(num_workers)]
+        for worker in self.workers:
+            worker.start()
+
+    def submit(self, rows):
+        """Queue one row, or an (N x width) matrix of rows, returning a Future of the root value(s)"""
+        rows = np.asarray(rows, dtype=np.float64)
+        single = rows.ndim == 1
+        rows = rows.reshape(1, -1) if single else rows
+        width = len(self.variables) if self.variables is not None else self.compiled.num_leaves
+        if rows.ndim != 2 or rows.shape[1] != width:
+            raise ValueError('Expected rows of width {}, got shape {}'.format(width, rows.shape))
+        future = Future()
+        self.queue.put((rows, single, future))
+        return future
+
+    def evaluate(self, rows):
+        """Calculate the root value(s) for a row or matrix of rows, blocking until done"""
+        return self.submit(rows).result()
+
+    async def evaluate_async(self, rows):
+        """Calculate the root value(s) for a row or matrix of rows from a coroutine"""
+        return await asyncio.wrap_future(self.submit(rows))
+
+    def next_batch(self):
+        """Wait for a request, then gather more until the batch is full or max_delay has passed"""
+        request = self.queue.get()
+        if request is None:
+            return None
+        batch = [request]
+        size = len(request[0])
+        deadline = time.monotonic() + self.max_delay
+        while size < self.max_batch_size:
+            remaining = deadline - time.monotonic()
+            try:
+                request = self.queue.get(timeout=remaining) if remaining > 0 else self.queue.get_nowait()
+            except queue.Empty:
+                break
+            if request is None:
+                self.queue.put(None)  # Let the next batch see the shutdown
+                break
+            batch.append(request)
+            size += len(request[0])
+        return batch
+
+    def run(self):
+        """Worker loop, evaluating one batch at a time until closed"""
+        while True:
+            batch = self.next_batch()
+            if batch is None:
+                return
+            batch = [request for request in batch if request[2].set_running_or_notify_cancel()]
+            if not batch:
+                continue
+            try:
+                rows = np.concatenate([request[0] for request in batch])
+                if self.variables is None:
+                    values = self.compiled.evaluate_batch(rows, log_mode=self.log_mode)
+                elif self.log_mode:
+                    values = self.compiled.evaluate_batch(self.compiled.leaf_log_values(self.variables, rows),
+                                                          log_mode=True, log_leaves=True)
+                else:
+                    values = self.compiled.evaluate_batch(self.compiled.indicator_values(self.variables, rows))
+            except Exception as error:
+                for _, _, future in batch:
+                    future.set_exception(error)
+                continue
+            start = 0
+            for rows, single, future in batch:
+                result = values[start:start + len(rows)]
+                future.set_result(float(result[0]) if single else result)
+                start += len(rows)
+
+    def close(self):
+        """Finish the queued requests and stop the workers"""
+        for _ in self.workers:
+            self.queue.put(None)
+        for worker in self.workers:
+            worker.join()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
@@ -0,0 +1,714 @@
+from NodeType import NodeType
+from Node import SumNode, ProdNode, LeafNode, GaussianLeaf, CategoricalLeaf, gaussian_log_density, \
+    categorical_log_density
+from Layer import Layer
+from collections.abc import Sequence
+from array import array
+import numpy as np
+import json
+import struct
+
+# Integer codes used for node types in the compiled arrays
+LEAF, SUM, PRODUCT = 0, 1, 2
+TYPE_CODES = {NodeType.LEAF: LEAF, NodeType.SUM: SUM, NodeType.PRODUCT: PRODUCT}
+
+# Integer codes used for the distributions of the leaves
+INDICATOR, GAUSSIAN, CATEGORICAL = 0, 1, 2
+LEAF_KINDS = {LeafNode: INDICATOR, GaussianLeaf: GAUSSIAN, CategoricalLeaf: CATEGORICAL}
+
+
+# Binary file format written by CompiledSPN.save
+MAGIC = b'PYSPN\x00\x00\x00'
+FORMAT_VERSION = 2  # Version 1 files have indicator leaves only
+ALIGNMENT = 64
+
+
+def align(offset):
+    """Round offset up to the next multiple of ALIGNMENT"""
+    return -(-offset // ALIGNMENT) * ALIGNMENT
+
+
+class NameTable(Sequence):
+    """Node names decoded on access from concatenated utf-8 data and offsets"""
+    def __init__(self, data, offsets, start=0, stop=None):
+        self.data = data
+        self.offsets = offsets
+        self.start = start
+        self.stop = len(offsets) - 1 if stop is None else stop
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            start, stop, step = i.indices(len(self))
+            if step != 1:
+                return [self[j] for j in range(start, stop, step)]
+            return NameTable(self.data, self.offsets, self.start + start, self.start + max(start, stop))
+        if i < 0:
+            i += len(self)
+        if not 0 <= i < len(self):
+            raise IndexError(i)
+        i += self.start
+        return bytes(self.data[self.offsets[i]:self.offsets[i + 1]]).decode('utf-8')
+
+    def __len__(self):
+        return self.stop - self.start
+
+
+def topological_order(root):
+    """List the nodes reachable from root, children before parents"""
+    order = []
+    seen = set()
+    stack = [(root, False)]
+    # Iterative post-order, so deep graphs don't hit the recursion limit
+    while stack:
+        node, expanded = stack.pop()
+        if expanded:
+            order.append(node)
+            continue
+        if id(node) in seen:
+            continue
+        seen.add(id(node))
+        stack.append((node, True))
+        for child in reversed(node.children):
+            if id(child) not in seen:
+                stack.append((child, False))
+    return order
+
+
+class CompiledSPN:
+    """An SPN frozen into flat arrays, ordered bottom-up by height above the leaves
+
+    Leaves come first and the root last. Within every height the sum nodes come
+    before the product nodes, so the children of each block of nodes form one
+    contiguous range of edges that can be evaluated with a handful of array ops.
+    Each such block is a Layer, and the forward pass is one Layer.evaluate per layer.
+    Evaluation only reads the arrays; the evidence and scratch buffers belong to each call,
+    so one instance can serve concurrent queries from many threads.
+    """
+    def __init__(self, node_types, heights, child_offsets, child_indices, edge_weights, names,
+                 edge_log_weights=None, edge_parents=None, levels=None, leaf_kinds=None, leaf_variables=None,
+                 parameter_offsets=None, parameters=None):
+        # Derived arrays can be passed in precomputed, e.g. memory-mapped by load()
+        self.node_types = np.asarray(node_types, dtype=np.int8)
+        self.heights = np.asarray(heights, dtype=np.int32)
+        self.child_offsets = np.asarray(child_offsets, dtype=np.int64)
+        self.child_indices = np.asarray(child_indices, dtype=np.int64)
+        self.edge_weights = np.asarray(edge_weights, dtype=np.float64)
+        if edge_log_weights is None:
+            with np.errstate(divide='ignore'):
+                edge_log_weights = np.log(self.edge_weights)
+        self.edge_log_weights = np.asarray(edge_log_weights, dtype=np.float64)
+        self.names = names if isinstance(names, NameTable) else list(names)
+        self.num_nodes = len(self.node_types)
+        self.num_edges = len(self.child_indices)
+        if edge_parents is None:
+            edge_parents = np.repeat(np.arange(self.num_nodes), np.diff(self.child_offsets))
+        self.edge_parents = np.asarray(edge_parents, dtype=np.int64)
+        self.levels = self._build_levels() if levels is None else [tuple(int(i) for i in level) for level in levels]
+        self.num_leaves = self.levels[0][0] if self.levels else self.num_nodes
+        self.leaf_names = self.names[:self.num_leaves]
+        self.root = self.num_nodes - 1
+        self.nodes = None  # The compiled Node objects, in order, when compiled from a live graph
+        self.layers = self._build_layers()
+        # The distribution, variable and parameters of every leaf, all empty for indicators
+        if leaf_kinds is None:
+            leaf_kinds = np.zeros(self.num_leaves)
+            leaf_variables = [''] * self.num_leaves
+            parameter_offsets = np.zeros(self.num_leaves + 1)
+            parameters = np.zeros(0)
+        self.leaf_kinds = np.asarray(leaf_kinds, dtype=np.int8)
+        self.leaf_variables = leaf_variables if isinstance(leaf_variables, NameTable) else list(leaf_variables)
+        self.parameter_offsets = np.asarray(parameter_offsets, dtype=np.int64)
+        self.parameters = np.asarray(parameters, dtype=np.float64)
+        self._build_leaf_parameters()
+
+    @classmethod
+    def from_root(cls, root):
+        """Compile the graph below root"""
+        return cls.from_nodes(topological_order(root))
+
+    @classmethod
+    def from_nodes(cls, order):
+        """Compile a graph from its nodes in topological order, children before parents"""
+        order = list(order)
+        heights = {}
+        for node in order:
+            if node.type == NodeType.LEAF:
+                heights[id(node)] = 0
+            elif not node.children:
+                raise ValueError('Cannot compile {}: it has no children'.format(node))
+            else:
+                heights[id(node)] = 1 + max(heights[id(child)] for child in node.children)
+        # Stable sort keeps the discovery order within each block
+        order.sort(key=lambda n: (heights[id(n)], TYPE_CODES[n.type]))
+        index = {id(node): i for i, node in enumerate(order)}
+
+        child_offsets = [0]
+        child_indices = []
+        edge_weights = []
+        for node in order:
+            child_indices.extend(index[id(child)] for child in node.children)
+            if node.type == NodeType.SUM:
+                edge_weights.extend(node.weights)
+            else:
+                edge_weights.extend([1.0] * len(node.children))
+            child_offsets.append(len(child_indices))
+
+        leaves = [node for node in order if node.type == NodeType.LEAF]
+        compiled = cls(node_types=[TYPE_CODES[node.type] for node in order],
+                       heights=[heights[id(node)] for node in order],
+                       child_offsets=child_offsets,
+                       child_indices=child_indices,
+                       edge_weights=edge_weights,
+                       names=[node.name for node in order],
+                       leaf_kinds=[LEAF_KINDS[type(leaf)] for leaf in leaves],
+                       leaf_variables=[getattr(leaf, 'variable', '') for leaf in leaves],
+                       parameter_offsets=np.cumsum([0] + [len(leaf.get_parameters()) for leaf in leaves]),
+                       parameters=[value for leaf in leaves for value in leaf.get_parameters()])
+        compiled.attach_nodes(order)
+        return compiled
+
+    def _build_levels(self):
+        """Find the (sum_start, sum_stop, prod_start, prod_stop) node ranges of every height"""
+        levels = []
+        bounds = np.flatnonzero(np.diff(self.heights)) + 1
+        starts = np.concatenate(([0], bounds))
+        stops = np.concatenate((bounds, [self.num_nodes]))
+        for start, stop in zip(starts[1:], stops[1:]):  # Height 0 holds the leaves
+            middle = start + int(np.count_nonzero(self.node_types[start:stop] == SUM))
+            levels.append((int(start), int(middle), int(middle), int(stop)))
+        return levels
+
+    def _build_layers(self):
+        """Split the levels into their sum and product Layers, bottom-up"""
+        layers = []
+        for sum_start, sum_stop, prod_start, prod_stop in self.levels:
+            if sum_stop > sum_start:
+                layers.append(Layer.from_compiled(self, NodeType.SUM, sum_start, sum_stop))
+            if prod_stop > prod_start:
+                layers.append(Layer.from_compiled(self, NodeType.PRODUCT, prod_start, prod_stop))
+        return layers
+
+    def _build_leaf_parameters(self):
+        """Gather the parameters of the Gaussian and categorical leaves into arrays for batch evaluation"""
+        starts = self.parameter_offsets[:-1]
+        self.gaussian_leaves = np.flatnonzero(self.leaf_kinds == GAUSSIAN)
+        self.gaussian_means = self.parameters[starts[self.gaussian_leaves]]
+        self.gaussian_stdevs = self.parameters[starts[self.gaussian_leaves] + 1]
+        self.categorical_leaves = np.flatnonzero(self.leaf_kinds == CATEGORICAL)
+        # Padded with impossible categories up to the largest number of categories
+        sizes = np.diff(self.parameter_offsets)[self.categorical_leaves]
+        self.categorical_log_probabilities = np.full((len(sizes), max(sizes, default=0)), -np.inf)
+        with np.errstate(divide='ignore'):
+            for i, (leaf, size) in enumerate(zip(self.categorical_leaves, sizes)):
+                self.categorical_log_probabilities[i, :size] = np.log(self.parameters[starts[leaf]:starts[leaf] + size])
+
+    def _segments(self, start, stop):
+        """Edge range of the nodes [start, stop) and each node's offset into it"""
+        first, last = self.child_offsets[start], self.child_offsets[stop]
+        return first, last, self.child_offsets[start:stop] - first
+
+    def forward(self, leaf_values, max_mode=False, log_mode=False):
+        """Calculate the values of all nodes for a (num_leaves x batch) matrix of leaf values
+
+        With log_mode=True the leaf values and the results are logs.
+        """
+        leaf_values = np.asarray(leaf_values, dtype=np.float64)
+        values = np.empty((self.num_nodes, leaf_values.shape[1]))
+        values[:self.num_leaves] = leaf_values
+        for layer in self.layers:
+            layer.evaluate(values, max_mode=max_mode, log_mode=log_mode)
+        return values
+
+    def evaluate(self, leaf_values, max_mode=False, log_mode=False):
+        """Calculate the root value for one vector of leaf values, ordered as leaf_names
+
+        With log_mode=True the log of the root value is calculated in log space.
+        """
+        return float(self.evaluate_batch(np.reshape(leaf_values, (1, self.num_leaves)),
+                                         max_mode=max_mode, log_mode=log_mode)[0])
+
+    def evaluate_batch(self, leaf_values, max_mode=False, log_mode=False, batch_size=4096, log_leaves=False):
+        """Calculate the root values for an (N x num_leaves) matrix of leaf values
+
+        Rows are processed batch_size at a time to bound the (num_nodes x batch_size) scratch matrix.
+        With log_mode=True the logs of the root values are calculated in log space. With
+        log_leaves=True the leaf values are already logs, as from leaf_log_values, so densities
+        too small for a float64 don't underflow to log(0).
+        """
+        leaf_values = np.asarray(leaf_values, dtype=np.float64)
+        if leaf_values.ndim != 2 or leaf_values.shape[1] != self.num_leaves:
+            raise ValueError('Expected leaf values of shape (N, {}), got {}'
+                             .format(self.num_leaves, leaf_values.shape))
+        result = np.empty(len(leaf_values))
+        for start in range(0, len(leaf_values), batch_size):
+            rows = leaf_values[start:start + batch_size].T
+            if log_leaves and not log_mode:
+                rows = np.exp(rows)
+            elif log_mode and not log_leaves:
+                with np.errstate(divide='ignore'):
+                    rows = np.log(rows)
+            values = self.forward(rows, max_mode=max_mode, log_mode=log_mode)
+            result[start:start + rows.shape[1]] = values[self.root]
+        return result
+
+    def select_edges(self, values, start, stop, log_mode=True):
+        """Pick the MAP child edge of each sum node in [start, stop) for every column of values
+
+        Ties go to the last child, like SumNode.update_map_weight_counts.
+        """
+        first, last, segments = self._segments(start, stop)
+        children = values[self.child_indices[first:last]]
+        if log_mode:
+            weighted = self.edge_log_weights[first:last, None] + children
+        else:
+            weighted = self.edge_weights[first:last, None] * children
+        best = np.maximum.reduceat(weighted, segments, axis=0)
+        is_best = weighted == np.repeat(best, np.diff(self.child_offsets[start:stop + 1]), axis=0)
+        edges = np.arange(first, last)[:, None]
+        return np.maximum.reduceat(np.where(is_best, edges, -1), segments, axis=0)
+
+    def sample_edges(self, values, start, stop, random):
+        """Draw a child edge of each sum node in [start, stop) for every column of a log-space sum pass
+
+        Each edge is drawn with probability proportional to its weight times its child's value.
+        """
+        first, last, segments = self._segments(start, stop)
+        lengths = np.diff(self.child_offsets[start:stop + 1])
+        weighted = self.edge_log_weights[first:last, None] + values[self.child_indices[first:last]]
+        best = np.maximum.reduceat(weighted, segments, axis=0)
+        probabilities = np.exp(weighted - np.repeat(np.where(np.isfinite(best), best, 0.0), lengths, axis=0))
+        # Cumulative probabilities within each segment, compared against one uniform draw per node
+        cumulative = np.cumsum(probabilities, axis=0)
+        cumulative -= np.repeat(cumulative[segments] - probabilities[segments], lengths, axis=0)
+        draws = random.random_sample(best.shape) * cumulative[segments + lengths - 1]
+        below = np.add.reduceat((cumulative < np.repeat(draws, lengths, axis=0)).astype(np.int64), segments, axis=0)
+        return self.child_offsets[start:stop, None] + np.minimum(below, lengths[:, None] - 1)
+
+    def backtrack(self, values, log_mode=True, random=None):
+        """Follow the MAP routes top-down from the root for every column of a max pass
+
+        Returns the (num_nodes x batch) number of routes that reach each node in each column,
+        and the number of routes through each edge summed over the columns. Shared nodes are
+        counted once per route, as in the recursive update_map_weight_counts. Given a
+        numpy RandomState and a log-space sum pass, the routes are sampled instead.
+        """
+        batch = values.shape[1]
+        columns = np.arange(batch)
+        routes = np.zeros((self.num_nodes, batch))
+        routes[self.root] = 1.0
+        counts = np.zeros(self.num_edges)
+        for sum_start, sum_stop, prod_start, prod_stop in reversed(self.levels):
+            if sum_stop > sum_start:
+                if random is not None:
+                    chosen = self.sample_edges(values, sum_start, sum_stop, random)
+                else:
+                    chosen = self.select_edges(values, sum_start, sum_stop, log_mode=log_mode)
+                reaching = routes[sum_start:sum_stop]
+                counts += np.bincount(chosen.ravel(), weights=reaching.ravel(), minlength=self.num_edges)
+                np.add.at(routes, (self.child_indices[chosen], columns), reaching)
+            if prod_stop > prod_start:
+                first, last, _ = self._segments(prod_start, prod_stop)
+                reaching = routes[self.edge_parents[first:last]]
+                counts[first:last] += reaching.sum(axis=1)
+                np.add.at(routes, self.child_indices[first:last], reaching)
+        return routes, counts
+
+    def map_counts(self, leaf_values, log_leaves=False):
+        """Count the MAP routes through each edge for an (N x num_leaves) matrix of leaf values
+
+        With log_leaves=True the leaf values are already logs, as from leaf_log_values.
+        """
+        leaf_values = np.asarray(leaf_values, dtype=np.float64).T
+        if not log_leaves:
+            with np.errstate(divide='ignore'):
+                leaf_values = np.log(leaf_values)
+        values = self.forward(leaf_values, max_mode=True, log_mode=True)
+        return self.backtrack(values)[1]
+
+    def normalise_counts_as_weights(self, counts):
+        """Normalise the counts on the links of each sum node to sum to one, as new edge weights
+
+        Sum nodes without any counts get zero weights; product edges keep a weight of one.
+        """
+        totals = np.bincount(self.edge_parents, weights=counts, minlength=self.num_nodes)[self.edge_parents]
+        weights = np.zeros(self.num_edges)
+        np.divide(counts, totals, out=weights, where=totals > 0)
+        is_product = self.node_types[self.edge_parents] == PRODUCT
+        weights[is_product] = 1.0
+        return weights
+
+    def set_weights(self, weights):
+        """Replace the edge weights"""
+        self.edge_weights = np.asarray(weights, dtype=np.float64)
+        with np.errstate(divide='ignore'):
+            self.edge_log_weights = np.log(self.edge_weights)
+        self.layers = self._build_layers()
+
+    def write_weights_to_nodes(self):
+        """Copy the edge weights back onto the links of the compiled sum nodes"""
+        if self.nodes is None:
+            raise ValueError('This compiled SPN has no nodes to write to, see to_spn')
+        for i, node in enumerate(self.nodes):
+            if self.node_types[i] == SUM:
+                first, last = self.child_offsets[i], self.child_offsets[i + 1]
+                np.frombuffer(node.weights)[:] = self.edge_weights[first:last]
+                node.mark_dirty()
+
+    def indicator_values(self, variables, data):
+        """Map binary data to an (N x num_leaves) matrix of indicator leaf values
+
+        A variable x sets leaf x to 1.0 when the sample is 1 and leaf x_ to 1.0 otherwise.
+        Missing values (NaN), and leaves that don't belong to any of the variables, are
+        marginalised out by setting the leaves to 1.0. Gaussian and categorical leaves are set
+        to the density of their variable's value, see leaf_log_values.
+        """
+        data = np.asarray(data, dtype=np.float64)
+        values = np.ones((len(data), self.num_leaves))
+        for i, (positive, negative) in enumerate(self.indicator_leaves(variables)):
+            observed = ~np.isnan(data[:, i])
+            if positive is not None:
+                values[observed, positive] = data[observed, i] == 1
+            if negative is not None:
+                values[observed, negative] = data[observed, i] != 1
+        for leaves, log_densities in self.parametric_log_values(variables, data):
+            values[:, leaves] = np.exp(log_densities)
+        return values
+
+    def leaf_log_values(self, variables, data, max_mode=False):
+        """Map data to an (N x num_leaves) matrix of log leaf values, see indicator_values
+
+        The log-densities of the parametric leaves are calculated directly in log space, one
+        array operation per distribution over all of its leaves and rows. For a max pass, use
+        max_mode=True: a missing value of a parametric leaf then takes the leaf's largest
+        density, at its mode, instead of being summed out to 1.
+        """
+        data = np.asarray(data, dtype=np.float64)
+        values = np.zeros((len(data), self.num_leaves))
+        for i, (positive, negative) in enumerate(self.indicator_leaves(variables)):
+            observed = ~np.isnan(data[:, i])
+            if positive is not None:
+                values[observed, positive] = np.where(data[observed, i] == 1, 0.0, -np.inf)
+            if negative is not None:
+                values[observed, negative] = np.where(data[observed, i] != 1, 0.0, -np.inf)
+        for leaves, log_densities in self.parametric_log_values(variables, data, max_mode=max_mode):
+            values[:, leaves] = log_densities
+        return values
+
+    def parametric_log_values(self, variables, data, max_mode=False):
+        """The (leaves, N x leaves log-densities) of the Gaussian and of the categorical leaves
+
+        Missing values are summed out to log(1), or take the log-density at the mode with max_mode=True.
+        """
+        results = []
+        if len(self.gaussian_leaves):
+            columns = self.leaf_columns(variables, data, self.gaussian_leaves)
+            log_densities = gaussian_log_density(columns, self.gaussian_means, self.gaussian_stdevs)
+            if max_mode:
+                modes = gaussian_log_density(self.gaussian_means, self.gaussian_means, self.gaussian_stdevs)
+                log_densities = np.where(np.isnan(columns), modes, log_densities)
+            results.append((self.gaussian_leaves, log_densities))
+        if len(self.categorical_leaves):
+            columns = self.leaf_columns(variables, data, self.categorical_leaves)
+            log_densities = categorical_log_density(columns, self.categorical_log_probabilities)
+            if max_mode:
+                modes = np.max(self.categorical_log_probabilities, axis=1)
+                log_densities = np.where(np.isnan(columns), modes, log_densities)
+            results.append((self.categorical_leaves, log_densities))
+        return results
+
+    def leaf_columns(self, variables, data, leaves):
+        """The (N x leaves) values of each leaf's variable, NaN where it isn't one of the variables"""
+        index = {variable: i for i, variable in enumerate(variables)}
+        columns = np.array([index.get(self.leaf_variables[leaf], -1) for leaf in leaves], dtype=np.int64)
+        if len(variables) == 0:
+            return np.full((len(data), len(leaves)), np.nan)
+        return np.where(columns >= 0, data[:, np.maximum(columns, 0)], np.nan)
+
+    def indicator_leaves(self, variables):
+        """The (x, x_) leaf indices of every variable, None where a leaf doesn't exist"""
+        index = {name: j for j, name in enumerate(self.leaf_names)}
+        return [(index.get(variable), index.get(variable + '_')) for variable in variables]
+
+    def mpe(self, variables, data, batch_size=4096):
+        """Complete the missing (NaN) values of every row of data with their most probable values
+
+        Uses one max pass and one MAP backtrack per batch: a missing variable is set to 1 when
+        the MAP routes reach its leaf x, and to 0 when they reach x_. A missing variable of a
+        Gaussian or categorical leaf is set to the leaf's mode. Returns the completed rows and
+        the log-probability (log-density) of each completed row, which is calculated in log
+        space as the probabilities of large models underflow.
+        """
+        data = np.array(data, dtype=np.float64)
+        log_probabilities = np.empty(len(data))
+        for start in range(0, len(data), batch_size):
+            rows = data[start:start + batch_size]
+            log_leaves = self.leaf_log_values(variables, rows, max_mode=True).T
+            routes = self.backtrack(self.forward(log_leaves, max_mode=True, log_mode=True))[0]
+            self.complete_from_routes(variables, rows, routes)
+            log_probabilities[start:start + len(rows)] = \
+                self.forward(self.leaf_log_values(variables, rows).T, log_mode=True)[self.root]
+        return data, log_probabilities
+
+    def complete_from_routes(self, variables, rows, routes, random=None):
+        """Fill in the missing (NaN) values of rows in place from the leaves the routes reach
+
+        Parametric leaves fill in their mode, or a draw from their distribution given a
+        numpy RandomState.
+        """
+        for i, (positive, negative) in enumerate(self.indicator_leaves(variables)):
+            missing = np.isnan(rows[:, i])
+            if negative is not None:
+                rows[missing & (routes[negative] > 0), i] = 0.0
+            if positive is not None:
+                rows[missing & (routes[positive] > 0), i] = 1.0
+        index = {variable: i for i, variable in enumerate(variables)}
+        for kind, leaves in ((GAUSSIAN, self.gaussian_leaves), (CATEGORICAL, self.categorical_leaves)):
+            columns = np.array([index.get(self.leaf_variables[leaf], -1) for leaf in leaves], dtype=np.int64)
+            known = columns >= 0
+            if not known.any():
+                continue
+            leaves, columns = leaves[known], columns[known]
+            if kind == GAUSSIAN:
+                means, stdevs = self.gaussian_means[known], self.gaussian_stdevs[known]
+                values = means + stdevs * random.standard_normal((len(rows), len(leaves))) if random is not None \
+                    else np.broadcast_to(means, (len(rows), len(leaves)))
+            else:
+                probabilities = np.exp(self.categorical_log_probabilities[known])
+                if random is not None:
+                    cumulative = np.cumsum(probabilities, axis=1)
+                    draws = random.random_sample((len(rows), len(leaves), 1)) * cumulative[:, -1:]
+                    values = np.minimum(np.sum(cumulative < draws, axis=2), probabilities.shape[1] - 1)
+                else:
+                    values = np.broadcast_to(np.argmax(probabilities, axis=1), (len(rows), len(leaves)))
+            # In a decomposable SPN every route reaches one leaf per variable
+            reached_rows, reached = np.nonzero(np.isnan(rows[:, columns]) & (routes[leaves].T > 0))
+            rows[reached_rows, columns[reached]] = values[reached_rows, reached]
+
+    def sample(self, variables, num_samples=None, evidence=None, batch_size=4096, random_state=None):
+        """Draw samples of the variables, one per row of evidence if given (missing values as NaN)
+
+        Every batch is one log-space sum pass over the evidence followed by one top-down walk
+        on arrays of sample columns: sum nodes draw a child from their weights times the child
+        values given the evidence, and product nodes pass each sample on to all children.
+        """
+        if evidence is None:
+            evidence = np.full((num_samples, len(variables)), np.nan)
+        samples = np.array(evidence, dtype=np.float64)
+        random = np.random.RandomState(random_state)
+        for start in range(0, len(samples), batch_size):
+            rows = samples[start:start + batch_size]
+            log_leaves = self.leaf_log_values(variables, rows).T
+            routes = self.backtrack(self.forward(log_leaves, log_mode=True), random=random)[0]
+            self.complete_from_routes(variables, rows, routes, random=random)
+        return samples
+
+    def log_derivatives(self, values):
+        """Calculate log(d root / d node) for every node from a log-space sum pass, top-down
+
+        A sum node passes its derivative times the link weight to each child. A product node
+        passes its derivative times the product of the other children, which is computed from
+        the sum of the finite child logs and the number of zero children, so no division by
+        a zero child is needed.
+        """
+        derivatives = np.full(values.shape, -np.inf)
+        derivatives[self.root] = 0.0
+        for sum_start, sum_stop, prod_start, prod_stop in reversed(self.levels):
+            if sum_stop > sum_start:
+                first, last, _ = self._segments(sum_start, sum_stop)
+                contributions = derivatives[self.edge_parents[first:last]] + self.edge_log_weights[first:last, None]
+                np.logaddexp.at(derivatives, self.child_indices[first:last], contributions)
+            if prod_stop > prod_start:
+                first, last, segments = self._segments(prod_start, prod_stop)
+                children = values[self.child_indices[first:last]]
+                is_zero = children == -np.inf
+                lengths = np.diff(self.child_offsets[prod_start:prod_stop + 1])
+                finite_sums = np.repeat(np.add.reduceat(np.where(is_zero, 0.0, children), segments, axis=0),
+                                        lengths, axis=0)
+                zeros = np.repeat(np.add.reduceat(is_zero.astype(np.int64), segments, axis=0), lengths, axis=0)
+                # Product of the other children: only non-zero if no other child is zero
+                others = np.where(is_zero, np.where(zeros == 1, finite_sums, -np.inf),
+                                  np.where(zeros == 0, finite_sums - np.where(is_zero, 0.0, children), -np.inf))
+                contributions = derivatives[self.edge_parents[first:last]] + others
+                np.logaddexp.at(derivatives, self.child_indices[first:last], contributions)
+        return derivatives
+
+    def marginals(self, variables, evidence, batch_size=4096):
+        """Calculate P(evidence) and P(x = 1 | evidence) of every variable, for every row of evidence
+
+        Missing values in evidence are NaN. Every posterior comes from the derivative of the
+        root with respect to the leaf x, so one upward and one downward pass per batch give
+        all of them: P(x = 1, evidence) = leaf x * d root / d leaf x. For a variable with
+        categorical leaves, P(x = 1, evidence) sums p(x = 1) * d root / d leaf over its leaves.
+        Variables with Gaussian leaves have no posterior and are left NaN.
+        """
+        evidence = np.asarray(evidence, dtype=np.float64)
+        probabilities = np.empty(len(evidence))
+        posteriors = np.full((len(evidence), len(variables)), np.nan)
+        leaves = self.indicator_leaves(variables)
+        positive = [i for i, (leaf, _) in enumerate(leaves) if leaf is not None]
+        negative = [i for i, (leaf, other) in enumerate(leaves) if leaf is None and other is not None]
+        index = {variable: i for i, variable in enumerate(variables)}
+        columns = np.array([index.get(self.leaf_variables[leaf], -1) for leaf in self.categorical_leaves],
+                           dtype=np.int64)
+        known = columns >= 0
+        categorical, columns = self.categorical_leaves[known], columns[known]
+        log_ones = self.categorical_log_probabilities[known, 1] if self.categorical_log_probabilities.shape[1] > 1 \
+            else np.full(len(categorical), -np.inf)
+        categorical_columns = np.unique(columns)
+        for start in range(0, len(evidence), batch_size):
+            rows = evidence[start:start + batch_size]
+            log_leaves = self.leaf_log_values(variables, rows).T
+            values = self.forward(log_leaves, log_mode=True)
+            derivatives = self.log_derivatives(values)
+            log_root = values[self.root]
+            stop = start + len(rows)
+            probabilities[start:stop] = np.exp(log_root)
+            with np.errstate(invalid='ignore'):
+                if positive:
+                    indices = [leaves[i][0] for i in positive]
+                    joint = log_leaves[indices] + derivatives[indices]
+                    posteriors[start:stop, positive] = np.exp(joint - log_root).T
+                if negative:
+                    indices = [leaves[i][1] for i in negative]
+                    joint = log_leaves[indices] + derivatives[indices]
+                    posteriors[start:stop, negative] = 1.0 - np.exp(joint - log_root).T
+                if len(categorical):
+                    joint = np.full((len(variables), len(rows)), -np.inf)
+                    np.logaddexp.at(joint, columns, derivatives[categorical] + log_ones[:, None])
+                    observed = rows[:, categorical_columns]
+                    posterior = np.exp(joint[categorical_columns] - log_root).T
+                    posteriors[start:stop, categorical_columns] = np.where(np.isnan(observed), posterior, observed == 1)
+        return probabilities, posteriors
+
+    def conditional(self, variables, query, evidence, batch_size=4096):
+        """Calculate P(evidence) and P(query | evidence) for every pair of rows
+
+        Missing values in query and evidence are NaN. The joint row takes the evidence where it
+        is observed and the query elsewhere, so a query that contradicts the evidence has
+        probability zero.
+        """
+        query = np.asarray(query, dtype=np.float64)
+        evidence = np.asarray(evidence, dtype=np.float64)
+        joint = np.where(np.isnan(evidence), query, evidence)
+        contradicts = np.any(~np.isnan(query) & ~np.isnan(evidence) & (query != evidence), axis=1)
+        log_evidence = self.evaluate_batch(self.leaf_log_values(variables, evidence), log_mode=True,
+                                           batch_size=batch_size, log_leaves=True)
+        log_joint = self.evaluate_batch(self.leaf_log_values(variables, joint), log_mode=True,
+                                        batch_size=batch_size, log_leaves=True)
+        log_joint[contradicts] = -np.inf
+        with np.errstate(invalid='ignore'):
+            return np.exp(log_evidence), np.exp(log_joint - log_evidence)
+
+    def save(self, path):
+        """Write the arrays to one binary file that load can memory-map
+
+        The file holds a magic string, the length of a JSON header describing the arrays, the
+        header, and then every array in native layout at a 64-byte aligned offset.
+        """
+        names = [name.encode('utf-8') for name in self.names]
+        leaf_variables = [variable.encode('utf-8') for variable in self.leaf_variables]
+        arrays = {
+            'node_types': self.node_types,
+            'heights': self.heights,
+            'child_offsets': self.child_offsets,
+            'child_indices': self.child_indices,
+            'edge_weights': self.edge_weights,
+            'edge_log_weights': self.edge_log_weights,
+            'edge_parents': self.edge_parents,
+            'levels': np.array(self.levels, dtype=np.int64).reshape(-1, 4),
+            'name_offsets': np.cumsum([0] + [len(name) for name in names], dtype=np.int64),
+            'name_data': np.frombuffer(b''.join(names), dtype=np.uint8),
+            'leaf_kinds': self.leaf_kinds,
+            'variable_offsets': np.cumsum([0] + [len(variable) for variable in leaf_variables], dtype=np.int64),
+            'variable_data': np.frombuffer(b''.join(leaf_variables), dtype=np.uint8),
+            'parameter_offsets': self.parameter_offsets,
+            'parameters': self.parameters,
+        }
+        header = {'version': FORMAT_VERSION, 'arrays': {}}
+        offset = 0
+        for key, values in arrays.items():
+            values = np.ascontiguousarray(values)
+            arrays[key] = values
+            header['arrays'][key] = {'dtype': values.dtype.str, 'shape': values.shape, 'offset': offset}
+            offset = align(offset + values.nbytes)
+        encoded = json.dumps(header).encode('utf-8')
+        data_start = align(len(MAGIC) + 8 + len(encoded))
+        with open(path, 'wb') as f:
+            f.write(MAGIC)
+            f.write(struct.pack('<Q', len(encoded)))
+            f.write(encoded)
+            for key, values in arrays.items():
+                f.seek(data_start + header['arrays'][key]['offset'])
+                f.write(values.tobytes())
+
+    @classmethod
+    def load(cls, path, mmap=True):
+        """Load a file written by save
+
+        With mmap=True the arrays are read-only views of the memory-mapped file, so loading
+        doesn't depend on the model size and processes on one host share the pages.
+        """
+        with open(path, 'rb') as f:
+            if f.read(len(MAGIC)) != MAGIC:
+                raise ValueError('{} is not a compiled SPN file'.format(path))
+            length, = struct.unpack('<Q', f.read(8))
+            header = json.loads(f.read(length).decode('utf-8'))
+        if header['version'] not in (1, FORMAT_VERSION):
+            raise ValueError('Unsupported compiled SPN file version: {}'.format(header['version']))
+        data_start = align(len(MAGIC) + 8 + length)
+        if mmap:
+            buffer = np.memmap(path, dtype=np.uint8, mode='r')
+        else:
+            buffer = np.fromfile(path, dtype=np.uint8)
+        arrays = {}
+        for key, spec in header['arrays'].items():
+            dtype = np.dtype(spec['dtype'])
+            start = data_start + spec['offset']
+            count = int(np.prod(spec['shape']))
+            arrays[key] = buffer[start:start + count * dtype.itemsize].view(dtype).reshape(spec['shape'])
+        return cls(node_types=arrays['node_types'],
+                   heights=arrays['heights'],
+                   child_offsets=arrays['child_offsets'],
+                   child_indices=arrays['child_indices'],
+                   edge_weights=arrays['edge_weights'],
+                   names=NameTable(arrays['name_data'], arrays['name_offsets']),
+                   edge_log_weights=arrays['edge_log_weights'],
+                   edge_parents=arrays['edge_parents'],
+                   levels=arrays['levels'],
+                   leaf_kinds=arrays.get('leaf_kinds'),
+                   leaf_variables=NameTable(arrays['variable_data'], arrays['variable_offsets'])
+                   if 'leaf_kinds' in arrays else None,
+                   parameter_offsets=arrays.get('parameter_offsets'),
+                   parameters=arrays.get('parameters'))
+
+    def to_nodes(self):
+        """Rebuild the Node objects, in order, and attach them as the compiled nodes"""
+        nodes = []
+        for i in range(self.num_nodes):
+            children = [nodes[j] for j in self.child_indices[self.child_offsets[i]:self.child_offsets[i + 1]]]
+            if self.node_types[i] == LEAF:
+                parameters = self.parameters[self.parameter_offsets[i]:self.parameter_offsets[i + 1]]
+                if self.leaf_kinds[i] == GAUSSIAN:
+                    node = GaussianLeaf(self.names[i], self.leaf_variables[i], *map(float, parameters))
+                elif self.leaf_kinds[i] == CATEGORICAL:
+                    node = CategoricalLeaf(self.names[i], self.leaf_variables[i], parameters)
+                else:
+                    node = LeafNode(self.names[i])
+            elif self.node_types[i] == SUM:
+                node = SumNode(self.names[i], children)
+                node.weights = array('d', self.edge_weights[self.child_offsets[i]:self.child_offsets[i + 1]])
+            else:
+                node = ProdNode(self.names[i], children)
+            nodes.append(node)
+        self.attach_nodes(nodes)
+        return nodes
+
+    def attach_nodes(self, nodes):
+        """Keep the Node objects the arrays were compiled from or rebuilt as, in order"""
+        self.nodes = nodes
+        for layer in self.layers:
+            layer.nodes = nodes[layer.start:layer.stop]
+
+    def __str__(self):
+        return 'Compiled SPN with {} nodes ({} leaves), {} edges and {} levels' \
+            .format(self.num_nodes, self.num_leaves, self.num_edges, len(self.levels))
@@ -0,0 +1,57 @@
+import numpy as np
+import pandas as pd
+import os
+import tempfile
+
+
+def open_array(source, dtype=np.float64, chunk_size=100000):
+    """Open a dataset as an array without reading it all into memory
+
+    Arrays and memory-maps are returned as they are, and .npy files are memory-mapped.
+    CSV files are streamed chunk by chunk into an anonymous memory-mapped file. Anything
+    else, like a list of samples, is converted to an in-memory array.
+    """
+    if isinstance(source, np.ndarray):
+        return source
+    if isinstance(source, str) and source.endswith('.npy'):
+        return np.load(source, mmap_mode='r')
+    if isinstance(source, str) and source.endswith('.csv'):
+        return spool_csv(source, dtype=dtype, chunk_size=chunk_size)
+    return np.asarray(source, dtype=dtype)
+
+
+def spool_csv(path, dtype=np.float64, chunk_size=100000):
+    """Copy a CSV file with a header row into a read-only memory-mapped array, one chunk at a time"""
+    handle, spool_path = tempfile.mkstemp(suffix='.bin')
+    rows = 0
+    columns = 0
+    with os.fdopen(handle, 'wb') as f:
+        for chunk in pd.read_csv(path, chunksize=chunk_size):
+            values = np.ascontiguousarray(chunk.values, dtype=dtype)
+            rows += len(values)
+            columns = values.shape[1]
+            f.write(values.tobytes())
+    if rows == 0:
+        os.remove(spool_path)
+        return np.empty((0, columns), dtype=dtype)
+    data = np.memmap(spool_path, dtype=dtype, mode='r', shape=(rows, columns))
+    try:
+        os.remove(spool_path)  # The mapping keeps the data until it is closed
+    except OSError:
+        pass
+    return data
+
+
+def iter_chunks(source, chunk_size=100000, dtype=np.float64):
+    """Yield a dataset as in-memory arrays of at most chunk_size rows
+
+    CSV files are read chunk by chunk; everything else is opened with open_array and sliced.
+    The source is re-read every time, so a path or array can be passed to several epochs.
+    """
+    if isinstance(source, str) and source.endswith('.csv'):
+        for chunk in pd.read_csv(source, chunksize=chunk_size):
+            yield np.asarray(chunk.values, dtype=dtype)
+        return
+    data = open_array(source, dtype=dtype)
+    for start in range(0, len(data), chunk_size):
+        yield np.asarray(data[start:start + chunk_size])
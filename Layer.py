@@ -1,13 +1,92 @@
 from NodeType import NodeType
+from scipy import sparse
+import numpy as np
 
 
 class Layer:
-    """The structure for an SPN layer"""
-    def __init__(self, nodes):
+    """The structure for an SPN layer
+
+    A compiled layer covers the block of nodes [start, stop) of one type and height in a
+    CompiledSPN, and evaluates them for a whole batch in a few array operations: a sum
+    layer is a sparse weight matrix times the values of the nodes below it, and a product
+    layer is a segmented product over the index array of its children.
+    """
+    def __init__(self, nodes, type=None, start=0, stop=None):
         self.nodes = nodes
+        self.type = type
+        self.start = start
+        self.stop = start + len(nodes) if stop is None else stop
+        self._segments = None
+        self._weights = None
+
+    @classmethod
+    def from_compiled(cls, compiled, type, start, stop):
+        """The layer of the compiled nodes [start, stop), all of the given NodeType
+
+        The layer only keeps views of the compiled arrays; its segment offsets and sparse
+        weight matrix are built on first use, so a memory-mapped SPN loads in constant time.
+        """
+        nodes = compiled.nodes[start:stop] if compiled.nodes is not None else []
+        layer = cls(nodes, type, start, stop)
+        first, last = compiled.child_offsets[start], compiled.child_offsets[stop]
+        layer.offsets = compiled.child_offsets[start:stop + 1]
+        layer.child_indices = compiled.child_indices[first:last]
+        if type == NodeType.SUM:
+            layer.edge_weights = compiled.edge_weights[first:last]
+            layer.log_weights = compiled.edge_log_weights[first:last]
+        return layer
+
+    @property
+    def segments(self):
+        """The offset of every node's children into the layer's edges"""
+        if self._segments is None:
+            self._segments = self.offsets[:-1] - self.offsets[0]
+        return self._segments
+
+    @property
+    def weights(self):
+        """The sparse (layer nodes x nodes below the layer) weight matrix of a sum layer"""
+        if self._weights is None:
+            # Built from the int64 arrays directly, as scipy would otherwise copy the indices to int32
+            weights = sparse.csr_matrix((len(self), self.start))
+            weights.data = np.asarray(self.edge_weights)
+            weights.indices = np.asarray(self.child_indices)
+            weights.indptr = self.offsets - self.offsets[0]
+            self._weights = weights
+        return self._weights
 
     def add_node(self, node):
         self.nodes.append(node)
 
     def get_leaves(self):
-        return [node for node in self.nodes if node.type == NodeType.LEAF]
\ No newline at end of file
+        return [node for node in self.nodes if node.type == NodeType.LEAF]
+
+    def evaluate(self, values, max_mode=False, log_mode=False):
+        """Calculate the layer's rows of a (num_nodes x batch) value matrix from the rows below it"""
+        if self.type == NodeType.SUM and not (max_mode or log_mode):
+            values[self.start:self.stop] = self.weights @ values[:self.start]
+            return
+        children = values[self.child_indices]
+        if self.type == NodeType.PRODUCT:
+            reduce_product = np.add if log_mode else np.multiply
+            values[self.start:self.stop] = reduce_product.reduceat(children, self.segments, axis=0)
+        elif log_mode:
+            weighted = self.log_weights[:, None] + children
+            values[self.start:self.stop] = np.maximum.reduceat(weighted, self.segments, axis=0) if max_mode \
+                else segment_log_sum_exp(weighted, self.segments)
+        else:
+            weighted = self.edge_weights[:, None] * children
+            values[self.start:self.stop] = np.maximum.reduceat(weighted, self.segments, axis=0)
+
+    def __len__(self):
+        return self.stop - self.start
+
+
+def segment_log_sum_exp(values, segments):
+    """Calculate log(sum(exp(values))) over consecutive row segments without underflow"""
+    maximum = np.maximum.reduceat(values, segments, axis=0)
+    shift = np.where(np.isfinite(maximum), maximum, 0.0)
+    lengths = np.diff(np.append(segments, len(values)))
+    with np.errstate(divide='ignore'):
+        total = np.add.reduceat(np.exp(values - np.repeat(shift, lengths, axis=0)), segments, axis=0)
+        return np.log(total) + shift
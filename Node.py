@@ -1,21 +1,68 @@
 from NodeType import NodeType
+from collections.abc import Mapping, ValuesView, ItemsView
+from array import array
 import numpy as np
+import math
 import random
 
 
 class Node(object):
     """An SPN node"""
+    __slots__ = ('name', 'parents', 'children', 'value', 'log_value', 'dirty', 'evaluated_mode')
+    link_keys = ('child',)
+
     def add_parent(self, parent):
         self.parents.append(parent)
 
     def add_child(self, child):
         self.children.append(child)
         child.add_parent(self)
+        self.mark_dirty()
+
+    @property
+    def links(self):
+        """A view of the links to the children, keyed by child name"""
+        return Links(self)
 
-    def update_map_weight_counts(self):
+    def mark_dirty(self):
+        """Mark the node and all its ancestors as needing to be recalculated"""
+        stack = [self]
+        while stack:
+            node = stack.pop()
+            node.dirty = True
+            # Ancestors of a dirty node are already dirty
+            stack.extend(parent for parent in node.parents if not parent.dirty)
+
+    def update_map_weight_counts(self, log_mode=False):
         raise NotImplementedError()
 
-    def get_value(self, max_mode=False):
+    def get_value(self, max_mode=False, memo=None, log_mode=False, incremental=False):
+        """Calculate the value of the node
+
+        If a memo dict is given, every node is calculated at most once per query and its
+        value is recorded in memo, so shared subgraphs of a DAG aren't recomputed per path.
+        With log_mode=True the log of the value is calculated and stored in log_value instead.
+        With incremental=True, nodes that aren't dirty and were last calculated in the same
+        mode return their stored value without recalculating.
+        """
+        if memo is not None and self in memo:
+            return memo[self]
+        mode = (max_mode, log_mode)
+        if incremental and not self.dirty and self.evaluated_mode == mode:
+            return self.log_value if log_mode else self.value
+        value = self.calculate_value(max_mode=max_mode, memo=memo, log_mode=log_mode, incremental=incremental)
+        if log_mode:
+            self.log_value = value
+        else:
+            self.value = value
+        self.dirty = False
+        self.evaluated_mode = mode
+        if memo is not None:
+            memo[self] = value
+        return value
+
+    def calculate_value(self, max_mode=False, memo=None, log_mode=False, incremental=False):
+        """Calculate the value of the node from its children, see get_value"""
         raise NotImplementedError()
 
     def __str__(self):
@@ -24,113 +71,329 @@ class Node(object):
 
 
 class SumNode(Node):
-    """An SPN sum node"""
-    def __init__(self, name, children=[]):
+    """An SPN sum node
+
+    The weights and MAP counts of the links are kept in arrays parallel to children.
+    """
+    __slots__ = ('weights', 'counts')
+    type = NodeType.SUM
+    link_keys = ('child', 'weight', 'count')
+
+    def __init__(self, name, children=None):
         self.name = name
-        self.children = children
+        self.children = children if children is not None else []
+        self.parents = []
         # Set random weights
-        self.links = dict()
+        self.weights = array('d', [random.random() for _ in self.children])
+        self.counts = array('d', [0.0] * len(self.children))
         for child in self.children:
             child.add_parent(self)
-            link = dict()
-            link['child'] = child
-            link['weight'] = random.random()
-            link['count'] = 0
-            self.links[child.name] = link
         self.normalise_weights()
-        self.parents = []
-        self.type = NodeType.SUM
         self.value = 0.0
+        self.log_value = -np.inf
+        self.dirty = True
+        self.evaluated_mode = None
 
     def add_child(self, child, weight=None):
         self.children.append(child)
         child.add_parent(self)
-        link = dict()
-        link['child'] = child
-        link['weight'] = weight if weight else random.random()
-        link['count'] = 0
-        self.links[child.name] = link
+        self.weights.append(weight if weight else random.random())
+        self.counts.append(0.0)
+        self.mark_dirty()
 
     def normalise_weights(self):
-        total = np.sum(list(map(lambda l: l['weight'], self.links.values())))
-        for link in self.links.values():
-            link['weight'] /= total
+        weights = np.frombuffer(self.weights)
+        weights /= np.sum(weights)
+        self.dirty = True
 
-    def get_value(self, max_mode=False):
+    def get_log_weights(self):
+        """The log of the link weights, ordered as the children"""
+        with np.errstate(divide='ignore'):
+            return np.log(np.frombuffer(self.weights))
+
+    def calculate_value(self, max_mode=False, memo=None, log_mode=False, incremental=False):
+        if log_mode:
+            # One pass of scalar math, so the log-space pass costs about as much as the linear one:
+            # total holds the sum of exp(value - best) over the children seen so far
+            best = -math.inf
+            total = 0.0
+            for weight, child in zip(self.weights, self.children):
+                value = child.get_value(max_mode=max_mode, memo=memo, log_mode=True, incremental=incremental)
+                if weight <= 0 or value == -math.inf:
+                    continue
+                value += math.log(weight)
+                if value > best:
+                    total = total * math.exp(best - value) + 1.0
+                    best = value
+                else:
+                    total += math.exp(value - best)
+            if max_mode or best == -math.inf:
+                return best
+            return best + math.log(total)
         if not max_mode:
-            self.value = 0.0
-            for child in self.children:
-                self.value += self.links[child.name]['weight'] * child.get_value()
-            return self.value
+            value = 0.0
+            for weight, child in zip(self.weights, self.children):
+                value += weight * child.get_value(memo=memo, incremental=incremental)
+            return value
         else:
             max_child = {'node': None, 'value': None}
-            for child in self.children:
-                value = self.links[child.name]['weight'] * child.get_value(max_mode=True)
+            for weight, child in zip(self.weights, self.children):
+                value = weight * child.get_value(max_mode=True, memo=memo, incremental=incremental)
                 if not max_child['value'] or max_child['value'] < value:
                     max_child['node'] = child
                     max_child['value'] = value
-            self.value = max_child['value']
-            return self.value
+            return max_child['value']
 
-    def update_map_weight_counts(self):
-        maximum = {'value': 0, 'node': None}
-        for child in self.children:
-            val = child.value * self.links[child.name]['weight']
-            if val >= maximum['value']:
-                maximum['value'] = val
-                maximum['node'] = child
-        self.links[maximum['node'].name]['count'] += 1
-        maximum['node'].update_map_weight_counts()
+    def update_map_weight_counts(self, log_mode=False):
+        if log_mode:
+            values = self.get_log_weights() + np.array([child.log_value for child in self.children])
+            # Ties go to the last child, as in linear space
+            chosen = len(values) - 1 - np.argmax(values[::-1])
+        else:
+            maximum = {'value': 0, 'index': None}
+            for i, child in enumerate(self.children):
+                val = child.value * self.weights[i]
+                if val >= maximum['value']:
+                    maximum['value'] = val
+                    maximum['index'] = i
+            chosen = maximum['index']
+        self.counts[chosen] += 1
+        self.children[chosen].update_map_weight_counts(log_mode=log_mode)
 
     def normalise_counts_as_weights(self):
         """Normalise the counts by normalising so they sum to one, and then set that as the weights"""
+        weights = np.frombuffer(self.weights)
+        counts = np.frombuffer(self.counts)
         # Calculates the total by summing the counts of all links
-        total = np.sum(list(map(lambda l: l['count'], self.links.values())))
+        total = np.sum(counts)
         if total == 0:  # Set all weights and counts to zero
-            for link in self.links.values():
-                link['weight'] = 0.0
-                link['count'] = 0
+            weights[:] = 0.0
         else:
-            for link in self.links.values():
-                link['weight'] = 1.0 * link['count'] / total
-                link['count'] = 0
+            weights[:] = counts / total
+        counts[:] = 0.0
+        self.mark_dirty()
 
 
 class ProdNode(Node):
-    """An SPN product node"""
-    def __init__(self, name, children=[]):
+    """An SPN product node
+
+    The links keep a count, as they always have, in an array parallel to children.
+    """
+    __slots__ = ('counts',)
+    type = NodeType.PRODUCT
+    link_keys = ('child', 'count')
+
+    def __init__(self, name, children=None):
         self.name = name
         self.parents = []
-        self.links = dict()
-        self.children = children
+        self.children = children if children is not None else []
+        self.counts = array('d', [0.0] * len(self.children))
         for child in self.children:
             child.add_parent(self)
-            self.links[child.name] = {'child': child, 'count': 0.0}
         self.value = 0.0
-        self.type = NodeType.PRODUCT
+        self.log_value = -np.inf
+        self.dirty = True
+        self.evaluated_mode = None
 
-    def get_value(self, max_mode=False):
-        self.value = 1.0
+    def add_child(self, child):
+        self.children.append(child)
+        child.add_parent(self)
+        self.counts.append(0.0)
+        self.mark_dirty()
+
+    def calculate_value(self, max_mode=False, memo=None, log_mode=False, incremental=False):
+        value = 0.0 if log_mode else 1.0
         for child in self.children:
-            self.value = self.value * child.get_value(max_mode=max_mode)
-        return self.value
+            child_value = child.get_value(max_mode=max_mode, memo=memo, log_mode=log_mode, incremental=incremental)
+            value = value + child_value if log_mode else value * child_value
+        return value
 
-    def update_map_weight_counts(self):
+    def update_map_weight_counts(self, log_mode=False):
         for child in self.children:
-            child.update_map_weight_counts()
+            child.update_map_weight_counts(log_mode=log_mode)
 
 
 class LeafNode(Node):
     """An SPN leaf node"""
+    __slots__ = ()
+    type = NodeType.LEAF
+
     def __init__(self, name, value=1.0):
         self.name = name
         self.parents = []
         self.value = value
+        self.log_value = np.log(value) if value > 0 else -np.inf
+        self.dirty = True
+        self.evaluated_mode = None
         self.children = []
-        self.type = NodeType.LEAF
 
-    def get_value(self, max_mode=False):
+    def calculate_value(self, max_mode=False, memo=None, log_mode=False, incremental=False):
+        if log_mode:
+            return math.log(self.value) if self.value > 0 else -math.inf
         return self.value
 
-    def update_map_weight_counts(self):
+    def get_parameters(self):
+        """The parameters of the leaf's distribution, none for an indicator"""
+        return []
+
+    def update_map_weight_counts(self, log_mode=False):
         pass
+
+
+class GaussianLeaf(LeafNode):
+    """A leaf with the Gaussian density of one continuous variable"""
+    __slots__ = ('variable', 'mean', 'stdev')
+
+    def __init__(self, name, variable, mean=0.0, stdev=1.0):
+        LeafNode.__init__(self, name)
+        self.variable = variable
+        self.mean = mean
+        self.stdev = stdev
+
+    @classmethod
+    def from_data(cls, name, variable, values, min_stdev=1e-3):
+        """Fit the mean and standard deviation to the observed (not NaN) values"""
+        values = np.asarray(values, dtype=np.float64)
+        values = values[~np.isnan(values)]
+        if len(values) == 0:
+            return cls(name, variable)
+        return cls(name, variable, float(np.mean(values)), max(float(np.std(values)), min_stdev))
+
+    def get_parameters(self):
+        return [self.mean, self.stdev]
+
+    def log_density(self, values):
+        """The log-density of every value; missing (NaN) values are marginalised out to log(1)"""
+        return gaussian_log_density(values, self.mean, self.stdev)
+
+    def observe(self, value):
+        """Set the leaf value to the density of value, for evaluating the node graph"""
+        self.value = float(np.exp(self.log_density(value)))
+        self.mark_dirty()
+
+
+class CategoricalLeaf(LeafNode):
+    """A leaf with the probabilities of the categories 0, 1, ... of one discrete variable"""
+    __slots__ = ('variable', 'probabilities')
+
+    def __init__(self, name, variable, probabilities):
+        LeafNode.__init__(self, name)
+        self.variable = variable
+        self.probabilities = array('d', probabilities)
+
+    @classmethod
+    def from_data(cls, name, variable, values, num_categories, smoothing=1.0):
+        """Fit the probabilities to the observed (not NaN) values, with additive smoothing"""
+        values = np.asarray(values, dtype=np.float64)
+        values = values[~np.isnan(values)].astype(np.int64)
+        counts = np.bincount(values, minlength=num_categories)[:num_categories] + smoothing
+        return cls(name, variable, counts / np.sum(counts))
+
+    def get_parameters(self):
+        return list(self.probabilities)
+
+    def log_density(self, values):
+        """The log-probability of every value; missing (NaN) values are marginalised out to log(1)"""
+        with np.errstate(divide='ignore'):
+            return categorical_log_density(values, np.log(np.frombuffer(self.probabilities))[None, :])
+
+    def observe(self, value):
+        """Set the leaf value to the probability of value, for evaluating the node graph"""
+        self.value = float(np.exp(self.log_density(value)))
+        self.mark_dirty()
+
+
+class Links(Mapping):
+    """A view of a node's links keyed by child name, backed by the node's arrays"""
+    __slots__ = ('node',)
+
+    def __init__(self, node):
+        self.node = node
+
+    def __getitem__(self, name):
+        for i, child in enumerate(self.node.children):
+            if child.name == name:
+                return Link(self.node, i)
+        raise KeyError(name)
+
+    def __iter__(self):
+        return (child.name for child in self.node.children)
+
+    def __len__(self):
+        return len(self.node.children)
+
+    def values(self):
+        return LinksValuesView(self)
+
+    def items(self):
+        return LinksItemsView(self)
+
+
+class LinksValuesView(ValuesView):
+    """The links of a node, visited by index rather than looked up by name"""
+    def __iter__(self):
+        node = self._mapping.node
+        return (Link(node, i) for i in range(len(node.children)))
+
+
+class LinksItemsView(ItemsView):
+    """The (child name, link) pairs of a node, visited by index rather than looked up by name"""
+    def __iter__(self):
+        node = self._mapping.node
+        return ((child.name, Link(node, i)) for i, child in enumerate(node.children))
+
+
+class Link(Mapping):
+    """A view of one link, with 'child' and, for sum nodes, its 'weight' and 'count'"""
+    __slots__ = ('node', 'index')
+
+    def __init__(self, node, index):
+        self.node = node
+        self.index = index
+
+    def __getitem__(self, key):
+        if key == 'child':
+            return self.node.children[self.index]
+        if key not in self.node.link_keys:
+            raise KeyError(key)
+        return getattr(self.node, key + 's')[self.index]
+
+    def __setitem__(self, key, value):
+        if key == 'child' or key not in self.node.link_keys:
+            raise KeyError(key)
+        getattr(self.node, key + 's')[self.index] = value
+
+    def __iter__(self):
+        return iter(self.node.link_keys)
+
+    def __len__(self):
+        return len(self.node.link_keys)
+
+    def __repr__(self):
+        return repr(dict(self))
+
+
+def gaussian_log_density(values, means, stdevs):
+    """Gaussian log-densities of values, broadcasting over the means and standard deviations
+
+    Missing (NaN) values are marginalised out to log(1).
+    """
+    values = np.asarray(values, dtype=np.float64)
+    log_density = -0.5 * ((values - means) / stdevs) ** 2 - np.log(stdevs) - 0.5 * np.log(2 * np.pi)
+    return np.where(np.isnan(values), 0.0, log_density)
+
+
+def categorical_log_density(values, log_probabilities):
+    """Log-probabilities of the categories in values, where column j of values is scored
+    against row j of the (C x num_categories) log_probabilities
+
+    Values that aren't one of the categories are impossible, and missing (NaN) values are
+    marginalised out to log(1).
+    """
+    values = np.asarray(values, dtype=np.float64)
+    missing = np.isnan(values)
+    categories = np.where(missing, 0.0, values)
+    valid = (categories >= 0) & (categories < log_probabilities.shape[1]) & (categories == np.floor(categories))
+    index = np.where(valid, categories, 0).astype(np.int64)
+    log_density = log_probabilities[np.arange(len(log_probabilities)), index]
+    return np.where(missing, 0.0, np.where(valid, log_density, -np.inf))
@@ -1,40 +1,202 @@
 from NodeType import NodeType
-from Node import SumNode, ProdNode, LeafNode
+from Node import SumNode, ProdNode, GaussianLeaf, CategoricalLeaf
+from CompiledSPN import CompiledSPN, topological_order
+from DataSource import open_array, iter_chunks
+from array import array
 import numpy as np
 import pandas as pd
-from sklearn.mixture.gaussian_mixture import GaussianMixture
-import random
+from sklearn.mixture import GaussianMixture
+from scipy import sparse
+from scipy.sparse.csgraph import connected_components
+from scipy.stats import chi2, rankdata
+import json
+import os
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+NAME_FORMATS = {NodeType.LEAF: 'LEAF_{}', NodeType.PRODUCT: 'P{}', NodeType.SUM: 'S{}'}
+CV_TYPES = ['spherical', 'tied', 'diag', 'full']
+MAX_FIT_ROWS = 100000  # Default sample size for fitting models during structure learning
+MAX_CATEGORIES = 32  # Columns with more integer values than this get Gaussian leaves
 
 
 class SPN:
     """The structure for an SPN"""
-    def __init__(self, nodes=[]):
-        self.nodes = nodes
+    def __init__(self, nodes=None):
+        self.nodes = []
         self.leaves = {}
-        for node in nodes:
-            if node.type == NodeType.LEAF:
-                self.leaves[node.name] = node
+        self.nodes_by_name = {}
+        self.nodes_by_type = {node_type: [] for node_type in NodeType}
+        self.root = None
+        self.topological_order = None
+        self.compiled = None
+        self.model_selection = {}  # Keyword arguments for find_best_model during structure learning
+        self.variables = []  # Names of the data columns used for structure learning
+        self.max_fit_rows = MAX_FIT_ROWS  # Rows sampled to fit models during structure learning, None for all
+        self.chunk_size = 100000  # Rows assigned to clusters at a time during structure learning
+        self.min_instances = 100  # Fewest rows to split on during structure learning
+        self.alpha = 0.001  # Significance level of the G-test of binary column independence
+        self.rdc_threshold = 0.3  # RDC above which continuous columns are dependent
+        self.categories = None  # Number of categories of every data column, 0 for continuous columns
+        self.evaluation_count = None  # Node evaluations done by the last memoised or compiled query
+        for node in nodes if nodes is not None else []:
+            self.add_node(node)
+
+    def add_node(self, node):
+        """Add a node to the SPN and its indexes"""
+        self.nodes.append(node)
+        self.nodes_by_name[node.name] = node
+        self.nodes_by_type[node.type].append(node)
+        if node.type == NodeType.LEAF:
+            self.leaves[node.name] = node
+        self.invalidate()
+
+    def invalidate(self):
+        """Drop the cached root, topological order and compiled arrays after the graph changed"""
+        self.root = None
+        self.topological_order = None
+        self.compiled = None
 
     def update_leaf(self, name, value):
-        """Update the value of the leaf"""
+        """Update the value of the leaf, and mark its ancestors for incremental re-evaluation"""
         self.leaves[name].value = value
+        self.leaves[name].mark_dirty()
 
-    def get_root(self):
+    def mark_dirty(self):
+        """Make the next incremental evaluation recalculate every node, e.g. after editing link weights
+
+        The compiled arrays are dropped too, so the next compiled query picks up the new weights.
+        """
         for node in self.nodes:
-            if len(node.parents) == 0:
-                return node
+            node.dirty = True
+        self.compiled = None
+
+    def get_root(self):
+        if self.root is None:
+            for node in self.nodes:
+                if len(node.parents) == 0:
+                    self.root = node
+                    break
+        return self.root
+
+    def get_topological_order(self):
+        """The nodes reachable from the root, children before parents"""
+        if self.topological_order is None:
+            self.topological_order = topological_order(self.get_root())
+        return self.topological_order
+
+    def compile(self):
+        """Freeze the current structure and weights into flat arrays for fast evaluation
+
+        Structural changes made through add_node or followed by invalidate(), and weight changes
+        made through normalise_counts_as_weights or followed by mark_dirty(), trigger a recompile
+        on the next compiled query.
+        """
+        self.compiled = CompiledSPN.from_nodes(self.get_topological_order())
+        return self.compiled
+
+    def get_layers(self):
+        """The compiled sum and product Layers, bottom-up by height above the leaves"""
+        if not self.compiled:
+            self.compile()
+        return self.compiled.layers
+
+    def save(self, path):
+        """Compile the SPN and save it to one binary file, see CompiledSPN.save"""
+        self.compile().save(path)
+
+    @classmethod
+    def load(cls, path, mmap=True):
+        """Load an SPN saved with save, rebuilding its nodes
+
+        The memory-mapped arrays are kept as the compiled SPN; for serving without the node
+        objects, use CompiledSPN.load directly.
+        """
+        compiled = CompiledSPN.load(path, mmap=mmap)
+        spn = cls(compiled.to_nodes())
+        spn.compiled = compiled
+        return spn
+
+    def get_root_value(self, max_mode=False, compiled=False, memoize=True, log_mode=False, incremental=False):
+        """Calculate the value at the root, calculated bottom-up
+
+        With compiled=True the compiled arrays are evaluated instead of walking the nodes,
+        so the intermediate node values are not updated. Otherwise, with memoize=True every
+        node shared between several parents is still only evaluated once per query.
+        With log_mode=True the log of the root value is calculated in log space.
+        With incremental=True only the nodes marked dirty since the last query in the same
+        mode are recalculated; leaves must then be changed through update_leaf.
+        """
+        if compiled:
+            if not self.compiled:
+                self.compile()
+            leaf_values = [self.leaves[name].value for name in self.compiled.leaf_names]
+            self.evaluation_count = self.compiled.num_nodes
+            return self.compiled.evaluate(leaf_values, max_mode=max_mode, log_mode=log_mode)
+        if not memoize:
+            self.evaluation_count = None
+            return self.get_root().get_value(max_mode=max_mode, log_mode=log_mode, incremental=incremental)
+        memo = {}
+        value = self.get_root().get_value(max_mode=max_mode, memo=memo, log_mode=log_mode, incremental=incremental)
+        self.evaluation_count = len(memo)
+        return value
+
+    def get_root_values(self, data, variables=None, max_mode=False, log_mode=False):
+        """Calculate the root value for every row of data in one vectorised pass
+
+        Without variables, data is an (N x num_leaves) matrix of leaf values ordered as
+        compiled.leaf_names. With variables, data holds binary samples as used in fit.
+        """
+        if not self.compiled:
+            self.compile()
+        if variables is None:
+            return self.compiled.evaluate_batch(data, max_mode=max_mode, log_mode=log_mode)
+        if log_mode:
+            # Parametric leaves are evaluated in log space, so far-out values don't underflow
+            return self.compiled.evaluate_batch(self.compiled.leaf_log_values(variables, data), max_mode=max_mode,
+                                                log_mode=True, log_leaves=True)
+        return self.compiled.evaluate_batch(self.compiled.indicator_values(variables, data), max_mode=max_mode)
+
+    def mpe(self, variables, data):
+        """Most probable completion of every row of data, with missing values as NaN
+
+        Returns the completed rows and their log-probabilities, see CompiledSPN.mpe.
+        """
+        if not self.compiled:
+            self.compile()
+        return self.compiled.mpe(variables, data)
+
+    def sample(self, variables, num_samples=None, evidence=None, random_state=None):
+        """Draw num_samples samples, or one sample per row of evidence with missing values as NaN
 
-    def get_root_value(self, max_mode=False):
-        """Calculate the value at the root, calculated bottom-up"""
-        return self.get_root().get_value(max_mode=max_mode)
+        See CompiledSPN.sample.
+        """
+        if not self.compiled:
+            self.compile()
+        return self.compiled.sample(variables, num_samples, evidence, random_state=random_state)
 
-    def calculate_map_route_counts(self):
+    def marginals(self, variables, evidence):
+        """P(evidence) and the posterior P(x = 1 | evidence) of every variable, for every row
+
+        Missing values are NaN, see CompiledSPN.marginals.
+        """
+        if not self.compiled:
+            self.compile()
+        return self.compiled.marginals(variables, evidence)
+
+    def conditional(self, variables, query, evidence):
+        """P(evidence) and P(query | evidence) for every pair of rows, see CompiledSPN.conditional"""
+        if not self.compiled:
+            self.compile()
+        return self.compiled.conditional(variables, query, evidence)
+
+    def calculate_map_route_counts(self, log_mode=False):
         """Calculate the routes followed for MAP state, and update counts"""
-        self.get_root().update_map_weight_counts()
+        self.get_root().update_map_weight_counts(log_mode=log_mode)
 
     def normalise_counts_as_weights(self, node=None):
         """Traverse the tree, and for sum nodes, normalise counts on links to sum to one and set as weights"""
         if not node:
+            self.compiled = None  # The compiled weights are stale
             root = self.get_root()
             root.normalise_counts_as_weights()
             self.normalise_counts_as_weights(root)
@@ -44,107 +206,361 @@ class SPN:
                     child.normalise_counts_as_weights()
                 self.normalise_counts_as_weights(child)
 
-    def fit(self, variables, data, epochs=100):
-        """Tries to lean appropriate weights for the current structure by applying hard EM"""
-        for epoch in range(epochs):
-            print('Epoch {}/{}'.format(epoch, epochs))
-            for leaf in self.leaves.values():
-                leaf.value = 0
-            for sample in data:
-                for i in range(len(sample)):
-                    # Set the leaves to match training example
-                    if sample[i] == 1:
-                        self.leaves[variables[i]].value = 1.0
-                        self.leaves[variables[i]+'_'].value = 0.0
-                    else :
-                        self.leaves[variables[i]].value = 0.0
-                        self.leaves[variables[i] + '_'].value = 1.0
-                # Calculate the max version bottom-up
-                self.get_root_value(True)
-                # Update the counts top-down
-                self.calculate_map_route_counts()
-            self.normalise_counts_as_weights()
-        for link in self.get_root().links.values():
-            print(link)
-
-    def create_structure(self, data, variables):
-        """Tries to learn appropriate structure from the data"""
-        self.learn_spn(pd.DataFrame(data, columns=variables))
-
-    def learn_spn(self, data, parent=None, weight=None):
+    def simplify(self):
+        """Shrink the graph below the root without changing the value it calculates
+
+        Sum nodes under sum nodes and product nodes under product nodes are merged into their
+        only parent, multiplying the weights through. Nodes with a single child (at weight one)
+        are replaced by that child, zero-weight links are dropped, and identical sub-graphs are
+        shared. Unreachable nodes are removed from the SPN. Passes repeat until nothing changes.
+        Returns the number of nodes and edges removed.
+        """
+        nodes_before = len(self.nodes)
+        edges_before = sum(len(node.children) for node in self.nodes)
+        root = self.get_root()
+        while True:
+            order = topological_order(root)
+            size = (len(order), sum(len(node.children) for node in order))
+            root = self.simplify_pass(order)
+            for node in order:
+                node.parents = []
+            order = topological_order(root)
+            for node in order:
+                for child in node.children:
+                    child.parents.append(node)
+            if (len(order), sum(len(node.children) for node in order)) == size:
+                break
+
+        reachable = set(id(node) for node in order)
+        nodes = [node for node in self.nodes if id(node) in reachable]
+        self.nodes = []
+        self.leaves = {}
+        self.nodes_by_name = {}
+        self.nodes_by_type = {node_type: [] for node_type in NodeType}
+        for node in nodes:
+            self.add_node(node)
+            node.dirty = True
+        return {'nodes': nodes_before - len(self.nodes),
+                'edges': edges_before - sum(len(node.children) for node in self.nodes)}
+
+    def simplify_pass(self, order):
+        """Rewrite the links of the nodes in topological order once, see simplify, returning the new root"""
+        replacements = {}  # id of a removed node -> the node that takes its place
+        shared = set()  # ids of nodes that gained parents during this pass
+        signatures = {}
+        for node in order:
+            if node.type == NodeType.LEAF:
+                continue
+            is_sum = node.type == NodeType.SUM
+            old_links = zip(node.children, node.weights, node.counts) if is_sum \
+                else ((child, 1.0, count) for child, count in zip(node.children, node.counts))
+            links = []
+            for child, weight, count in old_links:
+                child = replacements.get(id(child), child)
+                if is_sum and weight == 0.0 and any(node.weights):
+                    continue
+                if child.type == node.type and len(child.parents) == 1 and id(child) not in shared:
+                    # Merge the child into this node, multiplying its weights through
+                    if is_sum:
+                        links.extend((grandchild, weight * child_weight, 0.0)
+                                     for grandchild, child_weight in zip(child.children, child.weights))
+                    else:
+                        links.extend((grandchild, 1.0, 0.0) for grandchild in child.children)
+                else:
+                    links.append((child, weight, count))
+            if is_sum:
+                # A sum over the same child twice is that child at the total weight
+                merged = {}
+                for child, weight, count in links:
+                    total_weight, total_count = merged.get(child, (child, 0.0, 0.0))[1:]
+                    merged[child] = (child, total_weight + weight, total_count + count)
+                links = list(merged.values())
+                node.weights = array('d', [weight for _, weight, _ in links])
+            node.counts = array('d', [count for _, _, count in links])
+            node.children = [child for child, _, _ in links]
+
+            if len(links) == 1 and links[0][1] == 1.0:
+                replacements[id(node)] = node.children[0]
+                if len(node.parents) > 1:
+                    shared.add(id(node.children[0]))
+                continue
+            signature = (node.type, tuple(sorted((id(child), weight) for child, weight, _ in links)))
+            if signature in signatures:
+                replacements[id(node)] = signatures[signature]
+                shared.add(id(signatures[signature]))
+            else:
+                signatures[signature] = node
+        return replacements.get(id(order[-1]), order[-1])
+
+    def fit(self, variables, data, epochs=100, batch_size=4096, tol=1e-4, validation_data=None,
+            checkpoint_path=None, checkpoint_every=10, resume=False, verbose=False):
+        """Tries to lean appropriate weights for the current structure by applying hard EM
+
+        Every epoch does one vectorised max pass and MAP backtrack over the data, batch_size
+        rows at a time, and then sets the normalised MAP route counts as the new weights.
+        data can also be a memory-map or a .npy or .csv path, which is streamed every epoch.
+
+        Fitting stops early once the MAP counts stop changing, or once the mean log-likelihood
+        per row (of validation_data if given, else of the training data) improves by less than
+        tol. Every epoch is scored after its update, and the best scoring weights are the ones
+        kept when fitting stops. With a checkpoint_path the weights are saved every
+        checkpoint_every epochs and at the end, and resume=True continues from an existing
+        checkpoint. Returns the history of mean log-likelihoods per epoch.
+        """
+        compiled = self.compile()
+        if not isinstance(data, str):
+            data = open_array(data)
+        history = []
+        first_epoch = 0
+        if resume and checkpoint_path and os.path.exists(checkpoint_path):
+            first_epoch, history = load_checkpoint(checkpoint_path, compiled)
+        key = 'validation_log_likelihood' if validation_data is not None else 'train_log_likelihood'
+        best_score = -np.inf
+        best_weights = None
+        previous_counts = None
+        for epoch in range(first_epoch, epochs):
+            counts = np.zeros(compiled.num_edges)
+            for chunk in iter_chunks(data, batch_size):
+                counts += compiled.map_counts(compiled.leaf_log_values(variables, chunk), log_leaves=True)
+            compiled.set_weights(compiled.normalise_counts_as_weights(counts))
+
+            # Score the updated weights, so every record describes the weights it is kept with
+            train_log_likelihood = 0.0
+            rows = 0
+            for chunk in iter_chunks(data, batch_size):
+                train_log_likelihood += np.sum(compiled.evaluate_batch(compiled.leaf_log_values(variables, chunk),
+                                                                       log_mode=True, log_leaves=True))
+                rows += len(chunk)
+            record = {'epoch': epoch, 'train_log_likelihood': train_log_likelihood / max(rows, 1)}
+            if validation_data is not None:
+                record['validation_log_likelihood'] = np.mean(
+                    self.get_root_values(validation_data, variables, log_mode=True))
+            if verbose:
+                print('Epoch {}/{}: {}'.format(epoch, epochs, record))
+            if best_weights is None or record[key] > best_score:
+                best_score = record[key]
+                best_weights = compiled.edge_weights
+
+            converged = previous_counts is not None and np.array_equal(counts, previous_counts)
+            if history:
+                # Equal scores, such as two -inf scores, are no improvement, rather than -inf - -inf = NaN
+                previous = history[-1][key]
+                improvement = record[key] - previous if record[key] != previous else 0.0
+                if improvement < tol:
+                    converged = True
+            history.append(record)
+            previous_counts = counts
+            if converged and best_weights is not None and best_weights is not compiled.edge_weights:
+                compiled.set_weights(best_weights)  # Don't keep an update that made things worse
+            if checkpoint_path and (converged or (epoch + 1) % checkpoint_every == 0 or epoch + 1 == epochs):
+                save_checkpoint(checkpoint_path, compiled, epoch + 1, history)
+            if converged:
+                if verbose:
+                    print('Converged after epoch {}'.format(epoch))
+                break
+        compiled.write_weights_to_nodes()
+        if verbose:
+            for link in self.get_root().links.values():
+                print(link)
+        return history
+
+    def fit_online(self, variables, batches, kappa=0.7, offset=2.0, step_size=None, sync_every=1):
+        """Learn the weights from a stream of mini-batches with stepwise hard EM
+
+        Each batch's MAP route counts, per row, are blended into running statistics with step
+        size (t + offset) ** -kappa for the t-th batch, or a constant step_size (an exponential
+        decay of older batches), and the weights are set from the statistics after every batch.
+        The statistics start from the current weights, so sum nodes a batch doesn't reach keep
+        theirs. Memory doesn't depend on the length of the stream. The weights are written back
+        to the nodes every sync_every batches and at the end.
+        """
+        compiled = self.compile()
+        statistics = compiled.edge_weights.copy()
+        t = 0
+        for t, batch in enumerate(batches, 1):
+            batch = np.asarray(batch)
+            if len(batch) == 0:
+                continue
+            counts = compiled.map_counts(compiled.leaf_log_values(variables, batch), log_leaves=True)
+            eta = step_size if step_size is not None else (t + offset) ** -kappa
+            statistics = (1.0 - eta) * statistics + eta * counts / len(batch)
+            compiled.set_weights(compiled.normalise_counts_as_weights(statistics))
+            if t % sync_every == 0:
+                compiled.write_weights_to_nodes()
+        if t % sync_every != 0:
+            compiled.write_weights_to_nodes()
+        return compiled.edge_weights
+
+    def create_structure(self, data, variables, n_jobs=1, min_parallel_rows=1000, model_selection=None,
+                         max_fit_rows=MAX_FIT_ROWS, chunk_size=100000, min_instances=100, alpha=0.001,
+                         rdc_threshold=0.3):
+        """Tries to learn appropriate structure from the data
+
+        With n_jobs > 1, sub-trees learned from at least min_parallel_rows rows are sent to a
+        pool of n_jobs worker processes. They are merged back in the same order as a serial run,
+        so node naming is deterministic. model_selection holds keyword arguments for
+        find_best_model, e.g. {'strategy': 'fast', 'sample_size': 5000}.
+
+        data can be a memory-map or a .npy or .csv path, which is opened with open_array
+        instead of being read into memory. Clustering models and independence tests only see
+        at most max_fit_rows sampled rows (None for all of them), and rows are assigned to
+        clusters chunk_size at a time, so memory is bounded however large the data is.
+
+        Columns are tested for independence with a G-test at significance level alpha when the
+        data is binary, and with the RDC against rdc_threshold otherwise; see dependence_components.
+        """
+        self.model_selection = dict(model_selection or {})
+        self.variables = list(variables)
+        self.max_fit_rows = max_fit_rows
+        self.chunk_size = chunk_size
+        self.min_instances = min_instances
+        self.alpha = alpha
+        self.rdc_threshold = rdc_threshold
+        data = open_array(data, chunk_size=chunk_size)
+        self.categories = column_categories(data, chunk_size)
+        if not isinstance(data, np.memmap):
+            data = np.ascontiguousarray(data, dtype=np.float64)
+        if n_jobs == 1:
+            self.learn_spn(data)
+        else:
+            with ProcessPoolExecutor(max_workers=n_jobs) as executor:
+                self.learn_spn(data, executor=executor, min_parallel_rows=min_parallel_rows)
+
+    def new_name(self, node_type):
+        """Iteratively name learned nodes by counting the existing nodes of the same type"""
+        return NAME_FORMATS[node_type].format(len(self.nodes_by_type[node_type]))
+
+    def sample_rows(self, rows):
+        """At most max_fit_rows of rows, sampled without replacement and kept in order"""
+        if self.max_fit_rows and len(rows) > self.max_fit_rows:
+            return np.sort(np.random.choice(rows, self.max_fit_rows, replace=False))
+        return rows
+
+    def cluster_rows(self, data, rows, cols):
+        """Fit the best GMM to (a sample of) data[rows, cols] and assign every row to a cluster"""
+        model = find_best_model(gather(data, self.sample_rows(rows), cols), **self.model_selection)
+        # Gathered copies are dropped before the caller recurses
+        return np.concatenate([model.predict(gather(data, rows[start:start + self.chunk_size], cols))
+                               for start in range(0, len(rows), self.chunk_size)])
+
+    def create_leaf(self, data, rows, col):
+        """A categorical leaf for a column of categories, or else a Gaussian leaf, fitted to data[rows, col]"""
+        name = self.new_name(NodeType.LEAF)
+        variable = self.variables[col] if self.variables else str(col)
+        values = gather(data, rows, [col])[:, 0]
+        if self.categories is not None and self.categories[col]:
+            return CategoricalLeaf.from_data(name, variable, values, self.categories[col])
+        return GaussianLeaf.from_data(name, variable, values)
+
+    def learn_children(self, data, subsets, parent, weights, executor=None, min_parallel_rows=1000):
+        """Learn a sub-tree below parent from each (rows, cols) subset, in the worker pool if one is given"""
+        futures = []
+        for (rows, cols), weight in zip(subsets, weights):
+            if executor and len(rows) >= min_parallel_rows:
+                # Only the subset is sent to the worker, which learns from all of it
+                futures.append(executor.submit(learn_subtree, gather(data, rows, cols), weight, self.model_selection,
+                                               self.max_fit_rows, self.chunk_size, self.min_instances,
+                                               self.alpha, self.rdc_threshold,
+                                               [self.variables[col] for col in cols] if self.variables else None,
+                                               self.categories[cols] if self.categories is not None else None))
+            else:
+                futures.append(None)
+        # Merge in order, so the nodes are named exactly as in a serial run
+        for (rows, cols), weight, future in zip(subsets, weights, futures):
+            if future:
+                self.merge_subtree(future.result(), parent, weight)
+            else:
+                self.learn_spn(data, parent, weight, executor, min_parallel_rows, rows, cols)
+
+    def merge_subtree(self, nodes, parent, weight):
+        """Rename the nodes of a sub-tree learned by a worker, in creation order, and attach it to parent"""
+        for node in nodes:
+            node.name = self.new_name(node.type)
+            self.add_node(node)
+        subtree_root = nodes[0]
+        subtree_root.parents = []  # Drop the worker's placeholder parent
+        if weight:  # Parent is SumNode
+            parent.add_child(subtree_root, weight)
+        else:
+            parent.add_child(subtree_root)
+
+    def learn_spn(self, data, parent=None, weight=None, executor=None, min_parallel_rows=1000, rows=None, cols=None):
+        """Recursively learn the structure for data[rows, cols]
+
+        data is one contiguous array that is never copied as a whole; the recursion passes
+        row and column index arrays down, and only gathers a subset to fit a model on it.
+        Below the root, columns are split into the independent groups found by
+        dependence_components, and rows are clustered only when the columns don't separate.
+        Subsets with fewer than min_instances rows are factorised fully into leaves.
+        """
+        rows = np.arange(data.shape[0]) if rows is None else rows
+        cols = np.arange(data.shape[1]) if cols is None else cols
+        shape = (len(rows), len(cols))
+
         # Split rows on first pass
         if not parent:
-            print('Creating root node from data with shape: ', data.shape)
+            print('Creating root node from data with shape: ', shape)
             root = SumNode('root')
-            self.nodes.append(root)
-            model = find_best_model(data)  # Find best Gaussian Mixture Model
-            clusters = model.predict(data)  # Find the best clusters to split data into, row-wise
+            self.add_node(root)
+            clusters = self.cluster_rows(data, rows, cols)  # Find the best clusters to split data into, row-wise
             classes = np.unique(clusters)
             # Create the data subsets that will be children to this node
-            for c in classes:
-                subset = data[clusters == c]
-                weight = len(subset) / len(classes)
-                self.learn_spn(subset, root, weight)
+            subsets = [(rows[clusters == c], cols) for c in classes]
+            weights = [len(subset_rows) / len(rows) for subset_rows, _ in subsets]
+            self.learn_children(data, subsets, root, weights, executor, min_parallel_rows)
+
+        # Create leaf node if only 1x feature
+        elif len(cols) == 1:  # Create leaf node; scope == 1
+            print('Creating leaf node from data with shape: ', shape)
+            node = self.create_leaf(data, rows, cols[0])
+            parent.add_child(node)
+            self.add_node(node)
 
         else:
-            # Randomly decide whether to split on columns (for now)
-            split_features = random.randint(0, 2) > 1
-            print('split_features:', split_features)
-
-            # Create leaf node if only 1x feature
-            if len(data.columns) == 1:  # Create leaf node; scope == 1
-                print('Creating leaf node from data with shape: ', data.shape)
-                count = len([l for l in self.nodes if l.type == NodeType.LEAF])
-                name = 'LEAF_{}'.format(count)  # Iteratively name leaf nodes
-                node = LeafNode(name)
-                parent.add_child(node)
-                self.nodes.append(node)
+            if len(rows) < self.min_instances:
+                clusters = np.arange(len(cols))  # Too few rows to split on: factorise fully
+            else:
+                # Split on columns whenever they fall into independent groups
+                clusters = dependence_components(gather(data, self.sample_rows(rows), cols),
+                                                 self.alpha, self.rdc_threshold)
+            row_clusters = None
+            if clusters.max() == 0:
+                row_clusters = self.cluster_rows(data, rows, cols)  # Find the best clusters to split data into, row-wise
+                if len(np.unique(row_clusters)) == 1:
+                    print('Neither columns nor rows split, factorising fully.')
+                    clusters = np.arange(len(cols))
+                    row_clusters = None
 
             # Split features
-            elif split_features:
-                print('Creating product node from data with shape: ', data.shape)
-                count = len([p for p in self.nodes if p.type == NodeType.PRODUCT])
-                name = 'P{}'.format(count)  # Iteratively name product nodes
-                node = ProdNode(name)
+            if row_clusters is None:
+                print('Creating product node from data with shape: ', shape)
+                node = ProdNode(self.new_name(NodeType.PRODUCT))
                 if weight:  # Parent is SumNode
                     parent.add_child(node, weight)
                 else:  # Parent is ProdNode
                     parent.add_child(node)
-                self.nodes.append(node)
-                transposed = data.T
-                model = find_best_model(transposed)  # Find best Gaussian Mixture Model
-                clusters = model.predict(transposed)  # Find the best clusters to split data into, row-wise
-                classes = np.unique(clusters)
-                if len(classes) == 1:
-                    print('Classes don\'t want to split, forcing the issue.')
-                    clusters = np.array([1, 2])
-                    classes = np.unique(clusters)
+                self.add_node(node)
                 # Create the data subsets that will be children to this node
-                for c in classes:
-                    subset = transposed[clusters == c]
-                    self.learn_spn(subset.T, node, None)
+                subsets = [(rows, cols[clusters == c]) for c in np.unique(clusters)]
+                self.learn_children(data, subsets, node, [None] * len(subsets), executor, min_parallel_rows)
 
             # Split rows
             else:
-                count = len([s for s in self.nodes if s.type == NodeType.SUM])
-                name = 'S{}'.format(count)  # Iteratively name sum nodes
-                print('Creating sum node,', name, ', from data with shape: ', data.shape)
+                name = self.new_name(NodeType.SUM)
+                print('Creating sum node,', name, ', from data with shape: ', shape)
 
                 node = SumNode(name)
                 if weight:  # Parent is SumNode
                     parent.add_child(node, weight)
                 else:  # Parent is ProdNode
                     parent.add_child(node)
-                self.nodes.append(node)
-                model = find_best_model(data)  # Find best Gaussian Mixture Model
-                clusters = model.predict(data)  # Find the best clusters to split data into, row-wise
-                classes = np.unique(clusters)
+                self.add_node(node)
+                classes = np.unique(row_clusters)
                 print('classes:', classes)
                 # Create the data subsets that will be children to this node
-                for c in classes:
-                    subset = data[clusters == c]
-                    weight = len(subset) / len(classes)
-                    self.learn_spn(subset, node, weight)
+                subsets = [(rows[row_clusters == c], cols) for c in classes]
+                weights = [len(subset_rows) / len(rows) for subset_rows, _ in subsets]
+                self.learn_children(data, subsets, node, weights, executor, min_parallel_rows)
 
     def __str__(self):
         text = ''
@@ -154,25 +570,203 @@ class SPN:
         return text
 
 
-def find_best_model(data):
-    """Tries to find the best GMM for the data"""
-    lowest_bic = np.infty
-    bic = []
+def save_checkpoint(path, compiled, next_epoch, history):
+    """Save the edge weights and fit history, replacing the file atomically"""
+    temporary = path + '.tmp'
+    with open(temporary, 'wb') as f:
+        np.savez(f, edge_weights=compiled.edge_weights, next_epoch=next_epoch,
+                 history=np.array(json.dumps(history, default=float)))
+    os.replace(temporary, path)
+
+
+def load_checkpoint(path, compiled):
+    """Restore the edge weights from a checkpoint, returning the next epoch and the fit history"""
+    with np.load(path) as checkpoint:
+        weights = checkpoint['edge_weights']
+        if weights.shape != compiled.edge_weights.shape:
+            raise ValueError('Checkpoint {} has {} edge weights, expected {}'
+                             .format(path, len(weights), compiled.num_edges))
+        compiled.set_weights(weights)
+        return int(checkpoint['next_epoch']), json.loads(str(checkpoint['history']))
+
+
+def gather(data, rows, cols):
+    """Copy data[rows, cols] into a float64 array, reading only those rows of a memory-map"""
+    return np.asarray(data[np.ix_(rows, cols)], dtype=np.float64)
+
+
+def learn_subtree(data, weight, model_selection=None, max_fit_rows=MAX_FIT_ROWS, chunk_size=100000,
+                  min_instances=100, alpha=0.001, rdc_threshold=0.3, variables=None, categories=None):
+    """Learn a sub-tree in a worker process, returning its nodes in creation order
+
+    data holds only the sub-tree's columns, described by variables and categories.
+    """
+    spn = SPN()
+    spn.model_selection = dict(model_selection or {})
+    spn.max_fit_rows = max_fit_rows
+    spn.chunk_size = chunk_size
+    spn.min_instances = min_instances
+    spn.alpha = alpha
+    spn.rdc_threshold = rdc_threshold
+    spn.variables = list(variables or [])
+    spn.categories = categories
+    data = np.ascontiguousarray(data)
+    placeholder = SumNode('placeholder') if weight else ProdNode('placeholder')
+    spn.learn_spn(data, placeholder, weight)
+    return spn.nodes
+
+
+def column_categories(data, chunk_size=100000):
+    """The number of categories of every column of small non-negative integers, 0 for other columns
+
+    Columns with more than MAX_CATEGORIES values are treated as continuous.
+    """
+    integral = np.ones(data.shape[1], dtype=bool)
+    maximum = np.zeros(data.shape[1])
+    for chunk in iter_chunks(data, chunk_size):
+        chunk = np.asarray(chunk, dtype=np.float64)
+        observed = ~np.isnan(chunk)
+        integral &= np.all(~observed | ((chunk >= 0) & (chunk == np.floor(chunk))), axis=0)
+        maximum = np.maximum(maximum, np.max(np.where(observed, chunk, 0.0), axis=0, initial=0.0))
+    return np.where(integral & (maximum < MAX_CATEGORIES), maximum + 1, 0).astype(np.int64)
+
+
+def dependence_components(data, alpha=0.001, rdc_threshold=0.3, random_state=0):
+    """Label the columns of data with the connected components of their pairwise dependence graph
+
+    Binary data is tested with a G-test and continuous data with the RDC, over all column
+    pairs at once. Columns in different components can be modelled independently.
+    """
+    if np.isin(data, (0, 1)).all():
+        dependent = g_test(data) < alpha
+    else:
+        dependent = rdc(data, random_state=random_state) > rdc_threshold
+    return connected_components(sparse.csr_matrix(dependent), directed=False)[1]
+
+
+def g_test(data):
+    """P-values of the G-test of independence for every pair of binary columns"""
+    data = np.asarray(data, dtype=np.float64)
+    n = len(data)
+    ones = data.sum(axis=0)
+    zeros = n - ones
+    both = data.T.dot(data)  # Rows where columns i and j are both one
+    # Contingency counts of every pair (i, j) for (0, 0), (0, 1), (1, 0) and (1, 1)
+    observed = np.stack([n - ones[:, None] - ones[None, :] + both, ones[None, :] - both, ones[:, None] - both, both])
+    expected = np.stack([np.outer(zeros, zeros), np.outer(zeros, ones), np.outer(ones, zeros), np.outer(ones, ones)]) / n
+    with np.errstate(divide='ignore', invalid='ignore'):
+        terms = np.where(observed > 0, observed * np.log(observed / expected), 0.0)
+    return chi2.sf(2 * terms.sum(axis=0), 1)
+
+
+def rdc(data, k=10, s=1 / 6, random_state=None):
+    """The randomised dependence coefficient of every pair of columns (Lopez-Paz et al., 2013)
+
+    Each column is copula transformed, projected onto k random sine features, and every pair
+    scores the largest canonical correlation between their features.
+    """
+    data = np.asarray(data, dtype=np.float64)
+    n, d = data.shape
+    rng = np.random.RandomState(random_state)
+    ranks = rankdata(data, axis=0) / n
+    features = np.sin(s * (ranks[:, :, None] * rng.randn(d, k) + rng.randn(d, k)))
+    features -= features.mean(axis=0)
+    # An orthonormal basis of every column's features, dropping degenerate directions
+    basis, singular, _ = np.linalg.svd(features.transpose(1, 0, 2), full_matrices=False)
+    basis *= singular[:, None, :] > 1e-8 * singular[:, None, :1]
+    basis = basis.transpose(1, 0, 2).reshape(n, d * k)
+    # The canonical correlations of a pair are the singular values of their block of basis products
+    blocks = basis.T.dot(basis).reshape(d, k, d, k).transpose(0, 2, 1, 3)
+    return np.minimum(np.linalg.svd(blocks, compute_uv=False)[..., 0], 1.0)
+
+
+def find_best_model(data, strategy='exhaustive', max_components=10, cv_types=CV_TYPES,
+                    sample_size=None, patience=1, n_jobs=1, random_state=None):
+    """Tries to find the best GMM for the data
+
+    The 'exhaustive' strategy fits every covariance type with 1 to max_components components
+    and is kept as the reference. The 'fast' strategy starts at 2 components, initialises each
+    fit from the previous one with its largest component split in two, and stops once the BIC
+    hasn't improved for patience steps. Either strategy can fit and score on a random subsample of
+    sample_size rows, and search the covariance types in n_jobs threads.
+    """
+    if strategy not in ('exhaustive', 'fast'):
+        raise ValueError('Unknown model selection strategy: {}'.format(strategy))
+    rng = np.random.RandomState(random_state)
+    if sample_size and len(data) > sample_size:
+        sample = rng.choice(len(data), sample_size, replace=False)
+        data = data.iloc[sample] if isinstance(data, pd.DataFrame) else data[sample]
     num_samples = len(data)
-    upper = 10 if 10 < num_samples else num_samples
-    n_components_range = range(1, upper + 1)
-    cv_types = ['spherical', 'tied', 'diag', 'full']
-    for cv_type in cv_types:
-        for n_components in n_components_range:
-            # Fit a Gaussian mixture with EM
-            gmm = GaussianMixture(n_components=n_components, covariance_type=cv_type)
-            gmm.fit(data)
-            bic.append(gmm.bic(data))
-            if bic[-1] < lowest_bic and gmm.n_components > 1:  # Force a split into at least 2 components
-                lowest_bic = bic[-1]
-                best_gmm = gmm
+    upper = max_components if max_components < num_samples else num_samples
+    search = search_exhaustive if strategy == 'exhaustive' else search_fast
+    arguments = [(data, cv_type, upper, patience, random_state) for cv_type in cv_types]
+    if n_jobs == 1:
+        results = [search(*args) for args in arguments]
+    else:
+        with ThreadPoolExecutor(max_workers=n_jobs) as executor:
+            results = list(executor.map(lambda args: search(*args), arguments))
+
+    lowest_bic = np.inf
+    for bic, gmm in results:
+        if bic < lowest_bic:
+            lowest_bic = bic
+            best_gmm = gmm
 
     print('best_gmm.n_components:', best_gmm.n_components)
 
     return best_gmm
 
+
+def search_exhaustive(data, cv_type, upper, patience=None, random_state=None):
+    """Fit every number of components for one covariance type, returning the lowest BIC and its GMM"""
+    lowest_bic = np.inf
+    best_gmm = None
+    for n_components in range(1, upper + 1):
+        # Fit a Gaussian mixture with EM
+        gmm = GaussianMixture(n_components=n_components, covariance_type=cv_type, random_state=random_state)
+        gmm.fit(data)
+        bic = gmm.bic(data)
+        if bic < lowest_bic and gmm.n_components > 1:  # Force a split into at least 2 components
+            lowest_bic = bic
+            best_gmm = gmm
+    return lowest_bic, best_gmm
+
+
+def search_fast(data, cv_type, upper, patience=1, random_state=None):
+    """Grow the number of components for one covariance type from warm starts until the BIC stops improving"""
+    lowest_bic = np.inf
+    best_gmm = None
+    previous = None
+    stale = 0
+    values = np.asarray(data, dtype=np.float64)
+    for n_components in range(2, upper + 1):  # Force a split into at least 2 components
+        means_init = split_largest_component(previous, values) if previous is not None else None
+        gmm = GaussianMixture(n_components=n_components, covariance_type=cv_type,
+                              means_init=means_init, random_state=random_state)
+        gmm.fit(data)
+        bic = gmm.bic(data)
+        if bic < lowest_bic:
+            lowest_bic = bic
+            best_gmm = gmm
+            stale = 0
+        else:
+            stale += 1
+            if stale >= patience:
+                break
+        previous = gmm
+    return lowest_bic, best_gmm
+
+
+def split_largest_component(gmm, values):
+    """Initial means for one more component: the previous means, with the most populated
+    component split in two along its principal axis"""
+    labels = gmm.predict(values)
+    largest = np.argmax(np.bincount(labels, minlength=gmm.n_components))
+    members = values[labels == largest]
+    centred = members - members.mean(axis=0)
+    direction = np.linalg.svd(centred, full_matrices=False)[2][0]
+    side = centred.dot(direction) > 0
+    if side.all() or not side.any():
+        return None
+    means = np.delete(gmm.means_, largest, axis=0)
+    return np.vstack([means, members[side].mean(axis=0), members[~side].mean(axis=0)])
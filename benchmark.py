@@ -0,0 +1,231 @@
+"""Benchmarks for SPN evaluation, weight learning, structure learning and model selection
+
+Every benchmark runs on generated SPNs and data, is timed separately, and has its peak
+memory measured with tracemalloc in an extra run. Results are written as JSON together
+with the commit they were measured on, so runs can be compared across commits:
+
+    python benchmark.py --scale small --output before.json
+    python benchmark.py --scale small --output after.json --compare before.json
+"""
+from SPN import SPN, find_best_model
+from Node import SumNode, ProdNode, LeafNode
+from contextlib import redirect_stdout
+import numpy as np
+import argparse
+import datetime
+import io
+import json
+import platform
+import random
+import subprocess
+import time
+import tracemalloc
+
+# Sizes of the generated SPNs and datasets at every scale, from thousands to millions of rows
+SCALES = {
+    'small': {'num_variables': 16, 'depth': 4, 'fan_out': 3, 'rows': 10000, 'structure_rows': 2000,
+              'model_rows': 2000, 'epochs': 3},
+    'medium': {'num_variables': 32, 'depth': 6, 'fan_out': 3, 'rows': 100000, 'structure_rows': 10000,
+               'model_rows': 20000, 'epochs': 3},
+    'large': {'num_variables': 64, 'depth': 8, 'fan_out': 4, 'rows': 1000000, 'structure_rows': 50000,
+              'model_rows': 100000, 'epochs': 2},
+}
+
+
+def random_spn(num_variables, depth, fan_out, seed=0):
+    """Generate a random complete and decomposable SPN over binary variables x0, x1, ...
+
+    Sum nodes have fan_out children over the same scope, and product nodes split their scope
+    into up to fan_out random parts. Every variable has one pair of indicator leaves, xi and
+    xi_, shared by all the sum nodes over that variable alone. Returns the SPN and its variables.
+    """
+    rng = random.Random(seed)
+    variables = ['x{}'.format(i) for i in range(num_variables)]
+    leaves = {variable: (LeafNode(variable), LeafNode(variable + '_')) for variable in variables}
+    nodes = [leaf for pair in leaves.values() for leaf in pair]
+    counts = {'S': 0, 'P': 0}
+
+    def new_node(node_class, prefix, children):
+        node = node_class('{}{}'.format(prefix, counts[prefix]), children)
+        counts[prefix] += 1
+        nodes.append(node)
+        return node
+
+    def sum_node(scope, height):
+        if len(scope) == 1:
+            return new_node(SumNode, 'S', list(leaves[scope[0]]))
+        return new_node(SumNode, 'S', [product_node(scope, height - 1) for _ in range(fan_out)])
+
+    def product_node(scope, height):
+        scope = list(scope)
+        rng.shuffle(scope)
+        parts = len(scope) if height <= 1 else min(fan_out, len(scope))
+        return new_node(ProdNode, 'P', [sum_node(scope[i::parts], height - 1) for i in range(parts)])
+
+    # Sum node weights are drawn from the global random module
+    random.seed(seed)
+    sum_node(variables, depth)
+    return SPN(nodes), variables
+
+
+def generate_binary_data(num_rows, num_variables, num_clusters=4, seed=0):
+    """Sample binary rows from a mixture of num_clusters random product distributions"""
+    rng = np.random.RandomState(seed)
+    probabilities = rng.beta(0.5, 0.5, size=(num_clusters, num_variables))
+    clusters = rng.randint(num_clusters, size=num_rows)
+    return (rng.random_sample((num_rows, num_variables)) < probabilities[clusters]).astype(np.float64)
+
+
+def generate_continuous_data(num_rows, num_dimensions=2, num_clusters=3, seed=0):
+    """Sample rows from a mixture of num_clusters well separated unit Gaussians"""
+    rng = np.random.RandomState(seed)
+    centres = rng.uniform(-10, 10, size=(num_clusters, num_dimensions))
+    return rng.randn(num_rows, num_dimensions) + centres[rng.randint(num_clusters, size=num_rows)]
+
+
+def measure(function, repeat=3, memory=True):
+    """Time function, keeping the fastest of repeat runs, and find its peak memory in one more traced run"""
+    times = []
+    result = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = function()
+        times.append(time.perf_counter() - start)
+    record = {'seconds': min(times), 'runs': times}
+    if memory:
+        tracemalloc.start()
+        function()
+        record['peak_bytes'] = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+    return record, result
+
+
+def benchmark_root_value(config, repeat, memory):
+    """Time single queries on the node graph, compiled, and a batch of rows on the compiled arrays"""
+    spn, variables = random_spn(config['num_variables'], config['depth'], config['fan_out'])
+    data = generate_binary_data(config['rows'], config['num_variables'])
+    spn.compile()
+    parameters = {'nodes': len(spn.nodes), 'edges': sum(len(node.children) for node in spn.nodes)}
+    results = []
+    for name, function in [('get_root_value', lambda: spn.get_root_value()),
+                           ('get_root_value_compiled', lambda: spn.get_root_value(compiled=True)),
+                           ('get_root_values', lambda: spn.get_root_values(data, variables))]:
+        record, _ = measure(function, repeat, memory)
+        record.update(name=name, parameters=dict(parameters, rows=len(data) if name == 'get_root_values' else 1))
+        results.append(record)
+    return results
+
+
+def benchmark_fit(config, repeat, memory):
+    """Time hard EM per epoch on a random SPN"""
+    spn, variables = random_spn(config['num_variables'], config['depth'], config['fan_out'])
+    data = generate_binary_data(config['rows'], config['num_variables'])
+    record, history = measure(lambda: spn.fit(variables, data, epochs=config['epochs'], tol=-np.inf), repeat, memory)
+    epochs = max(len(history), 1)
+    record['seconds_per_epoch'] = record['seconds'] / epochs
+    record.update(name='fit', parameters={'rows': len(data), 'epochs': epochs, 'nodes': len(spn.nodes)})
+    return [record]
+
+
+def benchmark_structure(config, repeat, memory):
+    """Time structure learning on clustered binary data"""
+    data = generate_binary_data(config['structure_rows'], config['num_variables'])
+    variables = ['x{}'.format(i) for i in range(config['num_variables'])]
+
+    def learn():
+        spn = SPN()
+        with redirect_stdout(io.StringIO()):
+            spn.create_structure(data, variables, model_selection={'strategy': 'fast', 'random_state': 0})
+        return spn
+
+    record, spn = measure(learn, repeat, memory)
+    record.update(name='create_structure', parameters={'rows': len(data), 'columns': data.shape[1],
+                                                       'learned_nodes': len(spn.nodes)})
+    return [record]
+
+
+def benchmark_model_selection(config, repeat, memory):
+    """Time both model selection strategies on clustered continuous data"""
+    data = generate_continuous_data(config['model_rows'])
+    results = []
+    for strategy in ['exhaustive', 'fast']:
+        def select():
+            with redirect_stdout(io.StringIO()):
+                return find_best_model(data, strategy=strategy, random_state=0)
+        record, model = measure(select, repeat, memory)
+        record.update(name='find_best_model_' + strategy,
+                      parameters={'rows': len(data), 'components': int(model.n_components)})
+        results.append(record)
+    return results
+
+
+BENCHMARKS = {
+    'root_value': benchmark_root_value,
+    'fit': benchmark_fit,
+    'structure': benchmark_structure,
+    'model_selection': benchmark_model_selection,
+}
+
+
+def commit_hash():
+    """The current commit, marked dirty if the working tree has changes, or None outside git"""
+    try:
+        commit = subprocess.check_output(['git', 'rev-parse', 'HEAD'], stderr=subprocess.DEVNULL).decode().strip()
+        status = subprocess.check_output(['git', 'status', '--porcelain', '--untracked-files=no'],
+                                         stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+    return commit + ('-dirty' if status else '')
+
+
+def run_benchmarks(scale='small', names=None, repeat=3, memory=True, config=None):
+    """Run the named benchmarks, or all of them, returning the results as a JSON-ready dict"""
+    config = dict(SCALES[scale], **(config or {}))
+    results = []
+    for name in names or BENCHMARKS:
+        results.extend(BENCHMARKS[name](config, repeat, memory))
+    return {
+        'commit': commit_hash(),
+        'timestamp': datetime.datetime.now(datetime.timezone.utc).isoformat(),
+        'python': platform.python_version(),
+        'numpy': np.__version__,
+        'machine': platform.platform(),
+        'scale': scale,
+        'config': config,
+        'results': results,
+    }
+
+
+def compare(report, baseline):
+    """Print the time and peak memory of every benchmark relative to a baseline report"""
+    previous = {result['name']: result for result in baseline['results']}
+    print('Compared to {}:'.format(baseline.get('commit')))
+    for result in report['results']:
+        old = previous.get(result['name'])
+        if old is None:
+            continue
+        line = '{:<28} {:8.4f}s -> {:8.4f}s ({:5.2f}x)'.format(
+            result['name'], old['seconds'], result['seconds'], old['seconds'] / max(result['seconds'], 1e-12))
+        if 'peak_bytes' in result and 'peak_bytes' in old:
+            line += ', peak {:.1f} -> {:.1f} MiB'.format(old['peak_bytes'] / 2 ** 20, result['peak_bytes'] / 2 ** 20)
+        print(line)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--scale', choices=sorted(SCALES), default='small')
+    parser.add_argument('--only', nargs='+', choices=sorted(BENCHMARKS), help='benchmarks to run')
+    parser.add_argument('--repeat', type=int, default=3, help='timed runs per benchmark, the fastest is kept')
+    parser.add_argument('--no-memory', action='store_true', help='skip the traced run for peak memory')
+    parser.add_argument('--output', default='benchmark.json', help='path of the JSON results')
+    parser.add_argument('--compare', help='JSON results of an earlier run to compare against')
+    args = parser.parse_args()
+
+    report = run_benchmarks(args.scale, args.only, args.repeat, not args.no_memory)
+    with open(args.output, 'w') as f:
+        json.dump(report, f, indent=2)
+    for result in report['results']:
+        print('{:<28} {:8.4f}s  {}'.format(result['name'], result['seconds'], result['parameters']))
+    if args.compare:
+        with open(args.compare) as f:
+            compare(report, json.load(f))
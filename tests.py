@@ -1,7 +1,19 @@
+import asyncio
+import math
+import os
+import random
+import tempfile
 import unittest
-from SPN import SPN
-from Node import SumNode, LeafNode, ProdNode
+from array import array
+from SPN import SPN, find_best_model, dependence_components
+from Node import SumNode, LeafNode, ProdNode, GaussianLeaf, CategoricalLeaf
 from NodeType import NodeType
+from CompiledSPN import CompiledSPN
+from BatchEvaluator import BatchEvaluator
+from DataSource import open_array, iter_chunks
+from benchmark import random_spn, generate_binary_data, run_benchmarks
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
 
 
 class TestBasicSPN(unittest.TestCase):
@@ -120,3 +132,592 @@ class TestBasicSPN(unittest.TestCase):
             if node.type == NodeType.SUM:
                 for link in node.links.values():
                     self.assertEqual(link['count'], 0.0)
+
+    def test_incremental_evaluation(self):
+        """Test that updating one leaf only recalculates its ancestors"""
+        self.set_leaf_values()
+        self.spn.get_root_value(incremental=True)
+        self.assertEqual(self.spn.evaluation_count, 11)
+        self.assertEqual(self.spn.get_root_value(incremental=True), self.spn.get_root_value())
+
+        self.spn.get_root_value(incremental=True)
+        self.assertEqual(self.spn.evaluation_count, 0)
+
+        self.spn.update_leaf('x2', 1.0)
+        value = self.spn.get_root_value(incremental=True)
+        # Only x2 and its ancestors s3, s4, p1, p2 and s5 are recalculated
+        self.assertEqual(self.spn.evaluation_count, 6)
+        self.assertAlmostEqual(value, self.spn.get_root_value())
+
+        self.assertAlmostEqual(self.spn.get_root_value(max_mode=True, incremental=True),
+                               self.spn.get_root_value(max_mode=True))
+
+    def test_node_registry(self):
+        """Test the indexes kept on the SPN as nodes are added"""
+        self.assertIs(self.spn.get_root(), self.s5)
+        self.assertIs(self.spn.nodes_by_name['p2'], self.p2)
+        self.assertEqual(len(self.spn.nodes_by_type[NodeType.SUM]), 5)
+        self.assertEqual(len(self.spn.nodes_by_type[NodeType.LEAF]), 4)
+        order = self.spn.get_topological_order()
+        self.assertEqual(order[-1], self.s5)
+        self.assertTrue(order.index(self.x1) < order.index(self.s1) < order.index(self.p1))
+
+        self.spn.compile()
+        s6 = SumNode('s6', [self.s5])
+        self.spn.add_node(s6)
+        self.assertIsNone(self.spn.compiled)
+        self.assertIs(self.spn.get_root(), s6)
+        self.assertEqual(self.spn.get_topological_order()[-1], s6)
+
+    def test_links_view(self):
+        """Test that the links view reads and writes the compact weight and count arrays"""
+        self.set_leaf_values()
+        self.assertFalse(hasattr(self.s1, '__dict__'))
+        self.assertEqual(list(self.s1.weights), [0.8, 0.2])
+        self.s1.links['x1_']['count'] = 3
+        self.assertEqual(list(self.s1.counts), [0.0, 3.0])
+        self.assertEqual(dict(self.s5.links['p1']), {'child': self.p1, 'weight': 0.35, 'count': 0.0})
+        self.assertEqual(list(self.p1.links), ['s1', 's3'])
+        self.assertIs(self.p1.links['s3']['child'], self.s3)
+        self.assertEqual(dict(self.p1.links['s3']), {'child': self.s3, 'count': 0.0})
+        self.p1.links['s3']['count'] += 1
+        self.assertEqual([link['count'] for link in self.p1.links.values()], [0.0, 1.0])
+        self.assertEqual([name for name, link in self.s5.links.items() if link['weight'] > 0.5], ['p2'])
+        with self.assertRaises(KeyError):
+            self.p1.links['s3']['weight'] = 0.5
+
+    def test_compiled_root_value(self):
+        """Test that the compiled arrays give the same root value as the node graph"""
+        self.set_leaf_values()
+        compiled = self.spn.compile()
+
+        self.assertEqual(compiled.num_nodes, 11)
+        self.assertEqual(compiled.num_leaves, 4)
+        self.assertEqual(compiled.names[compiled.root], 's5')
+        self.assertAlmostEqual(self.spn.get_root_value(compiled=True), self.spn.get_root_value())
+        self.assertAlmostEqual(self.spn.get_root_value(max_mode=True, compiled=True), 0.234)
+
+    def test_compiled_weights_follow_node_weights(self):
+        """Test that changing the node weights recompiles before the next compiled query"""
+        self.set_leaf_values()
+        self.spn.compile()
+        self.spn.calculate_map_route_counts()
+        self.spn.normalise_counts_as_weights()
+        self.assertAlmostEqual(self.spn.get_root_value(compiled=True), self.spn.get_root_value())
+
+        self.s5.links['p1']['weight'] = 0.5
+        self.s5.links['p2']['weight'] = 0.5
+        self.spn.mark_dirty()
+        self.assertAlmostEqual(self.spn.get_root_value(compiled=True), self.spn.get_root_value())
+
+    def test_simplify(self):
+        """Test that simplifying removes redundant nodes and links without changing any value"""
+        self.set_leaf_values()
+        # A copy of p2, a zero-weight link, a sum under sums and a single-child root
+        s6 = SumNode('s6', [self.x2, self.x2_])
+        s6.weights[:] = self.s4.weights
+        p3 = ProdNode('p3', [self.s2, s6])
+        p4 = ProdNode('p4', [self.s1, self.s4])
+        self.s5.add_child(p4)
+        self.s5.links['p4']['weight'] = 0.0
+        s7 = SumNode('s7', [self.p2, p3])
+        s7.weights[:] = array('d', [0.5, 0.5])
+        top = SumNode('top', [self.s5, s7])
+        top.weights[:] = array('d', [0.6, 0.4])
+        root = ProdNode('root', [top])
+        for node in [s6, p3, p4, s7, top, root]:
+            self.spn.add_node(node)
+        samples = [[0, 0], [0, 1], [1, 0], [1, 1]]
+        expected = self.spn.get_root_values(samples, ['x1', 'x2'])
+
+        removed = self.spn.simplify()
+
+        self.assertEqual(removed, {'nodes': 6, 'edges': 12})
+        self.assertIs(self.spn.get_root(), top)
+        self.assertEqual(dict(zip(top.links, top.weights)), {'p1': 0.6 * 0.35, 'p2': 0.6 * 0.65 + 0.4})
+        self.assertEqual(self.s4.parents, [self.p2])
+        np.testing.assert_allclose(self.spn.get_root_values(samples, ['x1', 'x2']), expected)
+        self.assertAlmostEqual(self.spn.get_root_value(), self.spn.get_root_value(compiled=True))
+
+    def test_layers(self):
+        """Test that the SPN is split into sum and product layers by height above the leaves"""
+        self.set_leaf_values()
+        layers = self.spn.get_layers()
+
+        self.assertEqual([layer.type for layer in layers], [NodeType.SUM, NodeType.PRODUCT, NodeType.SUM])
+        self.assertEqual([sorted(node.name for node in layer.nodes) for layer in layers],
+                         [['s1', 's2', 's3', 's4'], ['p1', 'p2'], ['s5']])
+        self.assertEqual(layers[0].weights.shape, (4, 4))
+        compiled = self.spn.compiled
+        leaves = [[self.spn.nodes_by_name[name].value] for name in compiled.leaf_names]
+        values = compiled.forward(np.array(leaves))
+        self.assertAlmostEqual(values[compiled.root, 0], self.spn.get_root_value())
+
+    def test_mpe(self):
+        """Test completing missing values with the most probable assignment"""
+        self.set_leaf_values()
+        nan = float('nan')
+        completed, log_probabilities = self.spn.mpe(['x1', 'x2'], [[1, nan], [nan, 0], [nan, nan], [0, 1]])
+
+        np.testing.assert_array_equal(completed, [[1, 0], [1, 0], [1, 0], [0, 1]])
+        expected = self.spn.get_root_values(completed, ['x1', 'x2'])
+        np.testing.assert_allclose(np.exp(log_probabilities), expected)
+        # The completion of x2 given x1 = 1 is the more probable one
+        self.assertGreater(np.exp(log_probabilities[0]), self.spn.get_root_values([[1, 1]], ['x1', 'x2'])[0])
+
+    def test_mpe_of_large_model(self):
+        """Test that the log-probabilities of completed rows don't underflow on a model over many variables"""
+        spn, variables = random_spn(num_variables=1200, depth=2, fan_out=2)
+        evidence = np.full((3, len(variables)), np.nan)
+        evidence[:, :600] = generate_binary_data(3, 600)
+        completed, log_probabilities = spn.mpe(variables, evidence)
+        self.assertFalse(np.isnan(completed).any())
+        self.assertTrue(np.isfinite(log_probabilities).all())
+        np.testing.assert_allclose(log_probabilities, spn.get_root_values(completed, variables, log_mode=True))
+
+    def test_marginals_and_conditionals(self):
+        """Test all single-variable posteriors from one backward pass against enumeration"""
+        self.set_leaf_values()
+        nan = float('nan')
+        joint = {(x1, x2): self.spn.get_root_values([[x1, x2]], ['x1', 'x2'])[0] for x1 in (0, 1) for x2 in (0, 1)}
+        evidence = [[nan, nan], [1, nan], [nan, 0], [0, 1]]
+        probabilities, posteriors = self.spn.marginals(['x1', 'x2'], evidence)
+
+        np.testing.assert_allclose(probabilities, [1.0, joint[1, 0] + joint[1, 1], joint[0, 0] + joint[1, 0],
+                                                   joint[0, 1]])
+        np.testing.assert_allclose(posteriors[0], [joint[1, 0] + joint[1, 1], joint[0, 1] + joint[1, 1]])
+        np.testing.assert_allclose(posteriors[1], [1.0, joint[1, 1] / (joint[1, 0] + joint[1, 1])])
+        np.testing.assert_allclose(posteriors[2], [joint[1, 0] / (joint[0, 0] + joint[1, 0]), 0.0])
+        np.testing.assert_allclose(posteriors[3], [0.0, 1.0])
+
+        probabilities, conditionals = self.spn.conditional(['x1', 'x2'], [[nan, 1], [0, nan]], [[1, nan], [1, nan]])
+        np.testing.assert_allclose(conditionals, [joint[1, 1] / (joint[1, 0] + joint[1, 1]), 0.0])
+
+    def test_sampling(self):
+        """Test that sample frequencies match the joint, with and without evidence"""
+        self.set_leaf_values()
+        samples = self.spn.sample(['x1', 'x2'], 20000, random_state=0)
+        for x1, x2 in [(0, 0), (0, 1), (1, 0), (1, 1)]:
+            frequency = np.mean((samples[:, 0] == x1) & (samples[:, 1] == x2))
+            self.assertAlmostEqual(frequency, self.spn.get_root_values([[x1, x2]], ['x1', 'x2'])[0], delta=0.015)
+
+        evidence = np.tile([[1.0, float('nan')]], (20000, 1))
+        samples = self.spn.sample(['x1', 'x2'], evidence=evidence, random_state=0)
+        self.assertTrue((samples[:, 0] == 1).all())
+        posterior = self.spn.marginals(['x1', 'x2'], evidence[:1])[1][0, 1]
+        self.assertAlmostEqual(np.mean(samples[:, 1]), posterior, delta=0.015)
+
+    def test_save_and_load(self):
+        """Test saving to the binary format and loading it memory-mapped and as nodes"""
+        self.set_leaf_values()
+        data = [[1, 0], [0, 1], [1, 1], [0, 0]]
+        expected = self.spn.get_root_values(data, ['x1', 'x2'])
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'model.spn')
+            self.spn.save(path)
+
+            compiled = CompiledSPN.load(path)
+            self.assertIsInstance(compiled.edge_weights.base, np.memmap)
+            self.assertEqual(list(compiled.names), list(self.spn.compiled.names))
+            self.assertEqual(list(compiled.leaf_names), ['x1', 'x1_', 'x2', 'x2_'])
+            values = compiled.evaluate_batch(compiled.indicator_values(['x1', 'x2'], data))
+            np.testing.assert_allclose(values, expected)
+
+            spn = SPN.load(path, mmap=False)
+            self.assertIs(spn.get_root(), spn.nodes_by_name['s5'])
+            self.assertEqual(spn.nodes_by_name['s5'].links['p1']['weight'], 0.35)
+            np.testing.assert_allclose(spn.get_root_values(data, ['x1', 'x2']), expected)
+            np.testing.assert_allclose(spn.compile().edge_weights, self.spn.compiled.edge_weights)
+            del compiled, values
+
+    def test_batched_root_values(self):
+        """Test scoring many samples in one call"""
+        self.set_leaf_values()
+        data = [[1, 0], [0, 1], [1, 1], [0, 0]]
+        expected = []
+        for x1, x2 in data:
+            self.x1.value, self.x1_.value = x1, 1 - x1
+            self.x2.value, self.x2_.value = x2, 1 - x2
+            expected.append(self.spn.get_root_value())
+        values = self.spn.get_root_values(data, variables=['x1', 'x2'])
+
+        self.assertEqual(values.shape, (4,))
+        for value, target in zip(values, expected):
+            self.assertAlmostEqual(value, target)
+        self.assertAlmostEqual(sum(values), 1.0)
+
+    def test_memoised_evaluation_count(self):
+        """Test that shared leaves are only evaluated once per query, in both modes"""
+        self.set_leaf_values()
+        value = self.spn.get_root_value()
+        self.assertEqual(self.spn.evaluation_count, 11)
+        self.assertEqual(value, self.spn.get_root_value(memoize=False))
+
+        self.spn.get_root_value(max_mode=True)
+        self.assertEqual(self.spn.evaluation_count, 11)
+        self.assertAlmostEqual(self.s5.value, 0.234)
+
+    def test_log_space_evaluation(self):
+        """Test that log mode agrees with the linear value, for the nodes and the compiled arrays"""
+        self.set_leaf_values()
+        value = self.spn.get_root_value()
+        self.assertAlmostEqual(self.spn.get_root_value(log_mode=True), math.log(value))
+        self.assertAlmostEqual(self.spn.get_root_value(log_mode=True, compiled=True), math.log(value))
+        self.assertAlmostEqual(self.spn.get_root_value(max_mode=True, log_mode=True), math.log(0.234))
+
+        self.spn.calculate_map_route_counts(log_mode=True)
+        self.assertEqual(self.s2.links['x1']['count'], 1.0)
+        self.assertEqual(self.s4.links['x2_']['count'], 1.0)
+        self.assertEqual(self.s5.links['p2']['count'], 1.0)
+        self.assertEqual(self.s5.links['p1']['count'], 0.0)
+
+
+class TestLogSpaceSPN(unittest.TestCase):
+
+    def test_no_underflow(self):
+        """Test that the product of many small leaf values stays finite in log space"""
+        leaves = [LeafNode('x{}'.format(i), value=0.01) for i in range(500)]
+        product = ProdNode('p', leaves)
+        spn = SPN(leaves + [product])
+
+        self.assertEqual(spn.get_root_value(), 0.0)
+        self.assertAlmostEqual(spn.get_root_value(log_mode=True), 500 * math.log(0.01))
+        self.assertAlmostEqual(spn.get_root_value(log_mode=True, compiled=True), 500 * math.log(0.01))
+
+
+class TestFit(unittest.TestCase):
+
+    def setUp(self):
+        random.seed(0)
+        self.test = TestBasicSPN('set_leaf_values')
+        self.test.setUp()
+        self.test.set_leaf_values()
+        self.spn = self.test.spn
+        self.data = [[1, 0], [0, 1], [1, 1], [0, 0], [0, 1], [0, 1]]
+
+    def test_vectorised_map_counts(self):
+        """Test that the batched backtrack counts the same routes as the per-sample recursion"""
+        compiled = self.spn.compile()
+        counts = compiled.map_counts(compiled.indicator_values(['x1', 'x2'], self.data))
+
+        for x1, x2 in self.data:
+            self.test.x1.value, self.test.x1_.value = x1, 1 - x1
+            self.test.x2.value, self.test.x2_.value = x2, 1 - x2
+            self.spn.get_root_value(max_mode=True)
+            self.spn.calculate_map_route_counts()
+        for i, node in enumerate(compiled.nodes):
+            if node.type == NodeType.SUM:
+                for j, child in enumerate(node.children):
+                    self.assertEqual(counts[compiled.child_offsets[i] + j], node.links[child.name]['count'])
+
+    def test_fit_normalises_weights(self):
+        """Test that fitting leaves normalised weights on the sum nodes"""
+        self.spn.fit(['x1', 'x2'], self.data, epochs=3, batch_size=4)
+        for node in self.spn.nodes:
+            if node.type == NodeType.SUM:
+                total = sum(link['weight'] for link in node.links.values())
+                self.assertTrue(total == 0.0 or abs(total - 1.0) < 1e-9)
+        self.assertAlmostEqual(sum(self.spn.get_root_values(self.data, ['x1', 'x2'])[:4]), 1.0)
+
+    def test_fit_from_file(self):
+        """Test that fitting from a CSV file streamed in chunks matches fitting from memory"""
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'data.csv')
+            np.savetxt(path, self.data, delimiter=',', header='x1,x2', comments='', fmt='%d')
+            initial = self.spn.compile().edge_weights.copy()
+            self.spn.fit(['x1', 'x2'], path, epochs=2, batch_size=4)
+            from_file = self.spn.compiled.edge_weights
+            self.spn.compiled.set_weights(initial)
+            self.spn.compiled.write_weights_to_nodes()
+            self.spn.fit(['x1', 'x2'], self.data, epochs=2)
+            np.testing.assert_allclose(from_file, self.spn.compiled.edge_weights)
+
+    def test_fit_stops_early_and_resumes(self):
+        """Test that fit stops once the counts settle, and resumes from its checkpoint"""
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'weights.npz')
+            history = self.spn.fit(['x1', 'x2'], self.data, epochs=50, validation_data=self.data[:4],
+                                   checkpoint_path=path)
+            self.assertLess(len(history), 50)
+            self.assertIn('validation_log_likelihood', history[-1])
+            weights = self.spn.compiled.edge_weights.copy()
+
+            self.spn.compiled.set_weights(np.ones(self.spn.compiled.num_edges))
+            self.spn.compiled.write_weights_to_nodes()
+            resumed = self.spn.fit(['x1', 'x2'], self.data, epochs=len(history), checkpoint_path=path, resume=True)
+            self.assertEqual(len(resumed), len(history))
+            np.testing.assert_allclose(self.spn.compiled.edge_weights, weights)
+
+    def test_fit_keeps_best_weights(self):
+        """Test that every record scores the weights after its epoch, and that the best are kept"""
+        validation = [[1, 1], [1, 1], [0, 0]]
+        history = self.spn.fit(['x1', 'x2'], self.data, epochs=10, validation_data=validation, tol=0.0)
+        scores = [record['validation_log_likelihood'] for record in history]
+        self.assertAlmostEqual(np.mean(self.spn.get_root_values(validation, ['x1', 'x2'], log_mode=True)), max(scores))
+        self.assertAlmostEqual(np.mean(np.log(self.spn.get_root_values(self.data, ['x1', 'x2']))),
+                               history[scores.index(max(scores))]['train_log_likelihood'])
+
+    def test_fit_with_impossible_validation_row(self):
+        """Test fitting when every epoch gives a validation row of probability zero"""
+        with np.errstate(invalid='raise'):
+            history = self.spn.fit(['x1', 'x2'], [[0, 0]] * 5, epochs=5, validation_data=[[1, 1]])
+        self.assertTrue(all(record['validation_log_likelihood'] == -np.inf for record in history))
+        self.assertLess(len(history), 5)
+        self.assertAlmostEqual(self.spn.get_root_values([[0, 0]], ['x1', 'x2'])[0], 1.0)
+
+    def test_online_fit(self):
+        """Test streaming mini-batches, and that a full step on all data matches an epoch of hard EM"""
+        batches = (self.data[i:i + 2] for i in range(0, len(self.data), 2))
+        self.spn.fit_online(['x1', 'x2'], batches)
+        for node in self.spn.nodes:
+            if node.type == NodeType.SUM:
+                self.assertAlmostEqual(sum(node.weights), 1.0)
+
+        compiled = self.spn.compile()
+        counts = compiled.map_counts(compiled.indicator_values(['x1', 'x2'], self.data))
+        weights = self.spn.fit_online(['x1', 'x2'], [self.data], step_size=1.0)
+        np.testing.assert_allclose(weights, compiled.normalise_counts_as_weights(counts))
+
+
+class TestStructureLearning(unittest.TestCase):
+
+    def setUp(self):
+        random.seed(0)
+        self.data = [[1, 0], [0, 1], [1, 1], [0, 0]] * 25
+        self.variables = ['x1', 'x2']
+
+    def assert_well_formed(self, spn):
+        """Check that names are unique and iterative per type, and that links match the children"""
+        names = [node.name for node in spn.nodes]
+        self.assertEqual(len(names), len(set(names)))
+        for node_type, prefix in [(NodeType.LEAF, 'LEAF_'), (NodeType.PRODUCT, 'P')]:
+            typed = [node.name for node in spn.nodes if node.type == node_type]
+            self.assertEqual(typed, [prefix + str(i) for i in range(len(typed))])
+        for node in spn.nodes:
+            if node.type == NodeType.SUM:
+                self.assertEqual(sorted(node.links), sorted(child.name for child in node.children))
+            for child in node.children:
+                self.assertIn(node, child.parents)
+        self.assertEqual(len([node for node in spn.nodes if not node.parents]), 1)
+
+    def test_serial_structure(self):
+        """Test learning a structure from index arrays into the data"""
+        spn = SPN()
+        spn.create_structure(np.array(self.data), self.variables)
+        self.assert_well_formed(spn)
+        self.assertEqual(len([node for node in spn.nodes if node.type == NodeType.LEAF]) % 2, 0)
+
+    def test_independent_columns_split(self):
+        """Test that independent columns go straight to product nodes over single leaves"""
+        spn = SPN()
+        spn.create_structure(np.array(self.data), self.variables)
+        self.assertFalse([node for node in spn.nodes if node.type == NodeType.SUM and node is not spn.get_root()])
+        for node in spn.nodes_by_type[NodeType.PRODUCT]:
+            self.assertEqual([child.type for child in node.children], [NodeType.LEAF, NodeType.LEAF])
+
+    def test_dependence_components(self):
+        """Test grouping dependent binary columns with the G-test and continuous ones with the RDC"""
+        rng = np.random.RandomState(0)
+        binary = (rng.rand(500, 4) < 0.5).astype(float)
+        binary[:, 2] = np.where(rng.rand(500) < 0.9, binary[:, 0], 1 - binary[:, 0])
+        labels = dependence_components(binary)
+        self.assertEqual(labels[0], labels[2])
+        self.assertEqual(len(set(labels)), 3)
+
+        continuous = rng.randn(500, 3)
+        continuous[:, 1] = continuous[:, 0] ** 2 + 0.1 * rng.randn(500)
+        labels = dependence_components(continuous)
+        self.assertEqual(labels[0], labels[1])
+        self.assertNotEqual(labels[0], labels[2])
+
+    def test_parametric_leaves(self):
+        """Test learning Gaussian and categorical leaves, and evaluating and saving them in batch"""
+        rng = np.random.RandomState(0)
+        signal = rng.randn(400)
+        data = np.column_stack([signal, signal > 0, 2 * rng.randn(400) + 5])
+        variables = ['a', 'b', 'c']
+        spn = SPN()
+        spn.create_structure(data, variables)
+        self.assert_well_formed(spn)
+        kinds = {(type(leaf), leaf.variable) for leaf in spn.leaves.values()}
+        self.assertEqual(kinds, {(GaussianLeaf, 'a'), (CategoricalLeaf, 'b'), (GaussianLeaf, 'c')})
+
+        # The categories of b sum out to the density of a, and an unknown category is impossible
+        rows = [[0.5, 0, np.nan], [0.5, 1, np.nan], [0.5, np.nan, np.nan], [0.5, 2, np.nan]]
+        densities = spn.get_root_values(rows, variables)
+        self.assertAlmostEqual(densities[0] + densities[1], densities[2])
+        self.assertEqual(densities[3], 0.0)
+        leaf = next(leaf for leaf in spn.leaves.values() if leaf.variable == 'a')
+        self.assertAlmostEqual(leaf.log_density(np.array([1.0]))[0],
+                               -0.5 * ((1.0 - leaf.mean) / leaf.stdev) ** 2 - math.log(leaf.stdev * math.sqrt(2 * math.pi)))
+
+        completed, _ = spn.mpe(variables, [[np.nan, 1, np.nan], [np.nan, 0, np.nan]])
+        self.assertGreater(completed[0, 0], 0)
+        self.assertLess(completed[1, 0], 0)
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'model.spn')
+            spn.save(path)
+            loaded = SPN.load(path)
+            np.testing.assert_allclose(loaded.get_root_values(data[:10], variables), spn.get_root_values(data[:10], variables))
+
+    def test_categorical_mpe(self):
+        """Test that missing categorical values complete to the most probable assignment"""
+        leaves = [CategoricalLeaf('a1', 'a', [0.45, 0.55]), CategoricalLeaf('b1', 'b', [0.45, 0.55]),
+                  CategoricalLeaf('a2', 'a', [0.99, 0.01]), CategoricalLeaf('b2', 'b', [0.99, 0.01])]
+        p1 = ProdNode('p1', leaves[:2])
+        p2 = ProdNode('p2', leaves[2:])
+        root = SumNode('s', [p1, p2])
+        root.links['p1']['weight'] = 0.6
+        root.links['p2']['weight'] = 0.4
+        spn = SPN(leaves + [p1, p2, root])
+
+        joint = {(a, b): spn.get_root_values([[a, b]], ['a', 'b'])[0] for a in (0, 1) for b in (0, 1)}
+        completed, log_probabilities = spn.mpe(['a', 'b'], [[np.nan, np.nan]])
+        np.testing.assert_array_equal(completed, [[0, 0]])
+        self.assertEqual(max(joint, key=joint.get), (0, 0))
+        self.assertAlmostEqual(np.exp(log_probabilities[0]), joint[0, 0])
+
+    def test_far_gaussian_log_values(self):
+        """Test that log-space queries keep the log-density of a value far out in a Gaussian tail"""
+        leaves = [GaussianLeaf('a1', 'a', 0.0, 1.0), GaussianLeaf('a2', 'a', 1.0, 1.0)]
+        root = SumNode('s', leaves)
+        root.links['a1']['weight'] = 0.5
+        root.links['a2']['weight'] = 0.5
+        spn = SPN(leaves + [root])
+        expected = math.log(0.5) - 0.5 * 40.0 ** 2 - 0.5 * math.log(2 * math.pi) + math.log1p(math.exp(-39.5))
+
+        log_value = spn.get_root_values([[-40.0]], ['a'], log_mode=True)[0]
+        self.assertAlmostEqual(log_value, expected)
+        self.assertAlmostEqual(spn.compiled.conditional(['a'], [[np.nan]], [[-40.0]])[1][0], 1.0)
+        with BatchEvaluator(spn.compiled, variables=['a'], log_mode=True) as evaluator:
+            self.assertAlmostEqual(evaluator.evaluate([-40.0]), expected)
+
+        # Every row picks a leaf in the max pass, so the weights stay normalised
+        history = spn.fit(['a'], np.array([[-40.0], [-40.0], [1.0]]), epochs=1)
+        self.assertTrue(np.isfinite(history[-1]['train_log_likelihood']))
+        np.testing.assert_allclose(spn.compiled.edge_weights, [2 / 3, 1 / 3])
+
+    def test_learned_marginals(self):
+        """Test posteriors of a learned model with categorical leaves against enumeration"""
+        rng = np.random.RandomState(0)
+        signal = rng.rand(400) < 0.5
+        data = np.column_stack([signal, signal ^ (rng.rand(400) < 0.1), rng.rand(400) < 0.3]).astype(np.float64)
+        variables = ['a', 'b', 'c']
+        spn = SPN()
+        spn.create_structure(data, variables)
+        self.assertTrue(all(isinstance(leaf, CategoricalLeaf) for leaf in spn.leaves.values()))
+
+        evidence = [[1, np.nan, np.nan], [np.nan, 0, 1]]
+        probabilities, posteriors = spn.marginals(variables, evidence)
+        self.assertFalse(np.isnan(posteriors).any())
+        for row, probability, posterior in zip(evidence, probabilities, posteriors):
+            self.assertAlmostEqual(probability, spn.get_root_values([row], variables)[0])
+            for i, value in enumerate(row):
+                query = list(row)
+                query[i] = 1
+                expected = 1.0 if value == 1 else 0.0 if value == 0 else \
+                    spn.get_root_values([query], variables)[0] / probability
+                self.assertAlmostEqual(posterior[i], expected)
+
+    def test_out_of_core_structure_and_fit(self):
+        """Test learning from a memory-mapped .npy file and fitting from a streamed CSV file"""
+        with tempfile.TemporaryDirectory() as directory:
+            npy_path = os.path.join(directory, 'data.npy')
+            csv_path = os.path.join(directory, 'data.csv')
+            np.save(npy_path, np.array(self.data, dtype=np.float64))
+            np.savetxt(csv_path, self.data, delimiter=',', header='x1,x2', comments='', fmt='%d')
+
+            spn = SPN()
+            spn.create_structure(npy_path, self.variables, max_fit_rows=40, chunk_size=16)
+            self.assert_well_formed(spn)
+
+            np.testing.assert_array_equal(open_array(csv_path), self.data)
+            self.assertEqual([len(chunk) for chunk in iter_chunks(csv_path, 30)], [30, 30, 30, 10])
+
+    def test_default_fit_sample_is_bounded(self):
+        """Test that models are fitted on a bounded sample of rows unless asked otherwise"""
+        spn = SPN()
+        self.assertEqual(len(spn.sample_rows(np.arange(250000))), 100000)
+        spn.max_fit_rows = None
+        self.assertEqual(len(spn.sample_rows(np.arange(250000))), 250000)
+
+    def test_parallel_structure(self):
+        """Test that sub-trees learned in worker processes are merged into one well-formed SPN"""
+        spn = SPN()
+        spn.create_structure(self.data, self.variables, n_jobs=2, min_parallel_rows=1)
+        self.assert_well_formed(spn)
+        spn.compile()
+        self.assertEqual(spn.compiled.num_nodes, len(spn.nodes))
+
+
+class TestModelSelection(unittest.TestCase):
+
+    def setUp(self):
+        rng = np.random.RandomState(0)
+        centres = np.array([[0.0, 0.0], [6.0, 0.0], [0.0, 6.0]])
+        self.data = np.vstack([rng.randn(200, 2) + centre for centre in centres])
+
+    def test_fast_strategy(self):
+        """Test that the fast search finds the clusters from a subsample, in parallel"""
+        exhaustive = find_best_model(self.data, random_state=0)
+        fast = find_best_model(self.data, strategy='fast', sample_size=300, n_jobs=2, random_state=0)
+
+        self.assertEqual(exhaustive.n_components, 3)
+        self.assertEqual(fast.n_components, 3)
+
+    def test_unknown_strategy(self):
+        with self.assertRaises(ValueError):
+            find_best_model(self.data, strategy='greedy')
+
+
+class TestBatchEvaluator(unittest.TestCase):
+
+    def setUp(self):
+        self.test = TestBasicSPN('set_leaf_values')
+        self.test.setUp()
+        self.test.set_leaf_values()
+        self.compiled = self.test.spn.compile()
+        self.samples = [[1, 0], [0, 1], [1, 1], [0, 0]] * 50
+        self.expected = self.test.spn.get_root_values(self.samples, ['x1', 'x2'])
+
+    def test_concurrent_queries(self):
+        """Test that queries from many threads are batched and answered correctly"""
+        with BatchEvaluator(self.compiled, variables=['x1', 'x2'], max_delay=0.01) as evaluator:
+            with ThreadPoolExecutor(max_workers=16) as pool:
+                values = list(pool.map(evaluator.evaluate, self.samples))
+            np.testing.assert_allclose(values, self.expected)
+            np.testing.assert_allclose(evaluator.evaluate(self.samples[:3]), self.expected[:3])
+            with self.assertRaises(ValueError):
+                evaluator.submit([1, 0, 1])
+
+    def test_async_queries(self):
+        """Test answering queries from coroutines"""
+        leaf_values = self.compiled.indicator_values(['x1', 'x2'], self.samples)
+
+        async def query_all(evaluator):
+            return await asyncio.gather(*[evaluator.evaluate_async(row) for row in leaf_values])
+
+        with BatchEvaluator(self.compiled, num_workers=2) as evaluator:
+            values = asyncio.run(query_all(evaluator))
+        np.testing.assert_allclose(values, self.expected)
+
+
+class TestBenchmark(unittest.TestCase):
+
+    def test_random_spn(self):
+        """Test that generated SPNs are valid distributions over the generated data"""
+        spn, variables = random_spn(num_variables=5, depth=3, fan_out=2)
+        self.assertEqual(spn.get_root_value(), 1.0)
+        data = generate_binary_data(100, 5)
+        self.assertEqual(data.shape, (100, 5))
+        assignments = [[(i >> j) & 1 for j in range(5)] for i in range(32)]
+        self.assertAlmostEqual(np.sum(spn.get_root_values(assignments, variables)), 1.0)
+
+    def test_report(self):
+        """Test that a benchmark run reports the time and peak memory of every benchmark"""
+        report = run_benchmarks('small', ['root_value'], repeat=1, config={'rows': 100, 'num_variables': 4})
+        self.assertEqual([result['name'] for result in report['results']],
+                         ['get_root_value', 'get_root_value_compiled', 'get_root_values'])
+        for result in report['results']:
+            self.assertGreater(result['seconds'], 0)
+            self.assertGreater(result['peak_bytes'], 0)